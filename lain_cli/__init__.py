@@ -1 +1,5 @@
+from time import perf_counter
+
 __version__ = '4.7.2'
+# lain --profile reports everything after this as the imports phase
+IMPORT_STARTED_AT = perf_counter()
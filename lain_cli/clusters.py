@@ -32,6 +32,16 @@ CLUSTERS = MappingProxyType(
                     quantile_over_time(0.95,
                     container_memory_cache{{container!="sandbox",pod=~"{appname}-{proc_name}-[[:alnum:]]+-.+"}}[{range}]
                 ))''',
+                    # same as cpu, but for all deployments at once, the
+                    # deployment name is extracted from the pod name
+                    'cpu_by_deploy': '''quantile_over_time(0.9,
+                    max by (deploy) (
+                        label_replace(
+                            rate(container_cpu_user_seconds_total{{container!="sandbox"}}[{range}]),
+                            "deploy", "$1", "pod", "(.+)-[[:alnum:]]+-[[:alnum:]]+"
+                        )
+                    )[{range}:{step}s]
+                ) * 1000''',
                 },
                 # print grafana urls for app using lain status -s
                 'grafana_url': 'http://grafana.example.com/d/7sl4vJAZk/docker-monitoring',
@@ -3,7 +3,6 @@ import re
 from os import getcwd as cwd
 from os.path import join
 
-import gitlab
 from click import BadParameter
 
 from lain_cli.utils import (
@@ -13,6 +12,7 @@ from lain_cli.utils import (
     lain_,
     must_get_env,
     tell_cluster_info,
+    traced_session,
 )
 
 CWD = cwd()
@@ -29,7 +29,9 @@ def get_gitlab():
         'GITLAB_API_TOKEN',
         f'get your own token at {endpoint}/-/profile/personal_access_tokens',
     )
-    gl = gitlab.Gitlab(endpoint, private_token=token)
+    import gitlab
+
+    gl = gitlab.Gitlab(endpoint, private_token=token, session=traced_session())
     return gl
 
 
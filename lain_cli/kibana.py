@@ -10,6 +10,7 @@ class Kibana(RequestClientMixin):
 
     timezone = 'Asia/Shanghai'
     timeout = 40
+    hosts_per_query = 500
 
     def __init__(self):
         cluster_info = tell_cluster_info()
@@ -32,9 +33,27 @@ class Kibana(RequestClientMixin):
     def isoformat(dt):
         return f'{dt.isoformat()}Z'
 
-    def count_records_for_host(
-        self, host=None, ingress_class='lain-internal', period='7d'
+    def count_records_for_hosts(
+        self, hosts, ingress_class='lain-internal', period='7d'
     ):
+        """{host: request count} within period, counted by a single terms
+        aggregation on vhost, hosts without any records are left out. returns
+        None if the search failed or is incomplete, which must not be taken
+        as no traffic at all"""
+        hosts = sorted(hosts)
+        # every host is a clause in the query, mind max_clause_count
+        if len(hosts) > self.hosts_per_query:
+            counts = {}
+            for i in range(0, len(hosts), self.hosts_per_query):
+                batch = hosts[i : i + self.hosts_per_query]
+                batch_counts = self.count_records_for_hosts(
+                    batch, ingress_class=ingress_class, period=period
+                )
+                if batch_counts is None:
+                    return None
+                counts.update(batch_counts)
+
+            return counts
         path = '/internal/search/es'
         start = datetime.utcnow()
         delta = timedelta(seconds=parse_timespan(period))
@@ -46,30 +65,12 @@ class Kibana(RequestClientMixin):
         else:
             raise ValueError(f'weird ingress_class: {ingress_class}')
 
-        # query copied from browser
+        vhosts = ' OR '.join(f'"{host}"' for host in hosts)
         query = {
             'params': {
                 'body': {
-                    '_source': {'excludes': []},
                     'aggs': {
-                        '2': {
-                            'date_histogram': {
-                                'field': 'ts',
-                                'fixed_interval': '3h',
-                                'min_doc_count': 1,
-                                'time_zone': self.timezone,
-                            }
-                        }
-                    },
-                    'docvalue_fields': [
-                        {'field': '@timestamp', 'format': 'date_time'},
-                        {'field': 'ts', 'format': 'date_time'},
-                    ],
-                    'highlight': {
-                        'fields': {'*': {}},
-                        'fragment_size': 2147483647,
-                        'post_tags': ['@/kibana-highlighted-field@'],
-                        'pre_tags': ['@kibana-highlighted-field@'],
+                        'vhost': {'terms': {'field': 'vhost', 'size': len(hosts)}}
                     },
                     'query': {
                         'bool': {
@@ -82,26 +83,13 @@ class Kibana(RequestClientMixin):
                                             'gte': self.isoformat(end),
                                         }
                                     }
-                                }
-                            ],
-                            'must': [
-                                {
-                                    'query_string': {
-                                        'analyze_wildcard': True,
-                                        'query': f'vhost:"{host}"',
-                                        'time_zone': self.timezone,
-                                    }
-                                }
+                                },
+                                {'query_string': {'query': f'vhost:({vhosts})'}},
                             ],
-                            'must_not': [],
-                            'should': [],
                         }
                     },
-                    'script_fields': {},
-                    'size': 500,
-                    'sort': [{'ts': {'order': 'desc', 'unmapped_type': 'boolean'}}],
-                    'stored_fields': ['*'],
-                    'version': True,
+                    # only the aggregation is needed, not the records
+                    'size': 0,
                 },
                 'ignoreThrottled': True,
                 'ignore_throttled': True,
@@ -118,16 +106,25 @@ class Kibana(RequestClientMixin):
         responson = res.json()
         tries = 9
         request_id = responson.get('id')  # 没给 id 的话, 说明查询已经结束, 不用轮询结果了
-        if not request_id:
-            while responson['loaded'] != responson['total'] and tries:
+        if request_id:
+            while responson.get('loaded') != responson.get('total') and tries:
                 debug(f'polling kibana search results: {request_id}')
                 sleep(3)
                 res = self.post(path, json={'id': request_id})
                 responson = res.json()
                 tries -= 1
 
+        polled_out = request_id and responson.get('loaded') != responson.get('total')
+        if polled_out or responson.get('isPartial') or responson.get('isRunning'):
+            debug(f'kibana search incomplete: {request_id}')
+            return None
+        raw = responson.get('rawResponse') or {}
+        if raw.get('timed_out') or (raw.get('_shards') or {}).get('failed'):
+            debug(f'kibana search failed: {raw.get("_shards")}')
+            return None
         try:
-            count = responson['rawResponse']['hits']['total']
-        except KeyError:
-            return 0
-        return count
+            buckets = raw['aggregations']['vhost']['buckets']
+        except (KeyError, TypeError):
+            debug(f'weird kibana search result: {responson}')
+            return None
+        return {bucket['key']: bucket['doc_count'] for bucket in buckets}
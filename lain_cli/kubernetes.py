@@ -0,0 +1,212 @@
+import base64
+import os
+from functools import lru_cache
+from os.path import dirname, expanduser, join, realpath
+from subprocess import CompletedProcess
+from tempfile import TemporaryDirectory
+
+from lain_cli.utils import ENV, RequestClientMixin, debug, jalo, yalo
+
+# kind: (api prefix, plural, namespaced), only the stable APIs that lain
+# reads a lot are listed here, everything else goes through kubectl
+KUBERNETES_RESOURCES = {
+    'pod': ('api/v1', 'pods', True),
+    'secret': ('api/v1', 'secrets', True),
+    'service': ('api/v1', 'services', True),
+    'event': ('api/v1', 'events', True),
+    'node': ('api/v1', 'nodes', False),
+    'deployment': ('apis/apps/v1', 'deployments', True),
+    'job': ('apis/batch/v1', 'jobs', True),
+}
+KUBERNETES_KIND_ALIASES = {
+    'po': 'pod',
+    'pods': 'pod',
+    'secrets': 'secret',
+    'svc': 'service',
+    'services': 'service',
+    'ev': 'event',
+    'events': 'event',
+    'no': 'node',
+    'nodes': 'node',
+    'deploy': 'deployment',
+    'deployments': 'deployment',
+    'jobs': 'job',
+}
+
+
+class KubernetesClient(RequestClientMixin):
+    """talks to the API server using the credentials in kubeconfig, with a
+    keep-alive session. raises ValueError for kubeconfig features that only
+    kubectl supports (exec plugins, auth providers, etc)"""
+
+    timeout = 10
+
+    def __init__(self, kubeconfig):
+        import requests
+
+        with open(kubeconfig) as f:
+            config = yalo(f)
+
+        try:
+            context = self.pick(config['contexts'], config['current-context'])
+            cluster = self.pick(config['clusters'], context['cluster'])
+            user = self.pick(config['users'], context['user'])
+        except (KeyError, TypeError) as e:
+            raise ValueError(f'cannot understand kubeconfig {kubeconfig}: {e}') from e
+
+        unsupported = {'exec', 'auth-provider'}.intersection(user)
+        if unsupported:
+            raise ValueError(f'{unsupported} in kubeconfig, use kubectl instead')
+
+        self.kubeconfig = kubeconfig
+        self.namespace = context.get('namespace') or 'default'
+        self.endpoint = cluster['server'].rstrip('/')
+        self.headers = {'Accept': 'application/json'}
+        self.session = requests.Session()
+        # certificates and keys must be on disk for requests to use them
+        self.tempdir = TemporaryDirectory(prefix='lain-kube-')
+        if cluster.get('insecure-skip-tls-verify'):
+            self.session.verify = False
+        else:
+            ca = self.tell_file(cluster, 'certificate-authority')
+            if ca:
+                self.session.verify = ca
+
+        cert = self.tell_file(user, 'client-certificate')
+        if cert:
+            self.session.cert = (cert, self.tell_file(user, 'client-key'))
+
+        token = user.get('token')
+        if not token and user.get('tokenFile'):
+            with open(self.resolve_path(user['tokenFile'])) as f:
+                token = f.read().strip()
+
+        if token:
+            self.headers['Authorization'] = f'Bearer {token}'
+        elif user.get('username'):
+            self.session.auth = (user['username'], user.get('password', ''))
+
+    @staticmethod
+    def pick(named_list, name):
+        for d in named_list:
+            if d['name'] == name:
+                return next(v for k, v in d.items() if k != 'name')
+        raise KeyError(name)
+
+    def resolve_path(self, path):
+        # relative paths in kubeconfig are relative to the kubeconfig itself
+        return join(dirname(self.kubeconfig), expanduser(path))
+
+    def tell_file(self, dic, key):
+        data = dic.get(f'{key}-data')
+        if data:
+            path = join(self.tempdir.name, key)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(base64.b64decode(data))
+
+            return path
+        path = dic.get(key)
+        if path:
+            return self.resolve_path(path)
+        return None
+
+    def tell_path(self, kind, name=None):
+        kind = KUBERNETES_KIND_ALIASES.get(kind, kind)
+        if kind not in KUBERNETES_RESOURCES:
+            return None
+        prefix, plural, namespaced = KUBERNETES_RESOURCES[kind]
+        path = f'/{prefix}'
+        if namespaced:
+            path += f'/namespaces/{self.namespace}'
+
+        path += f'/{plural}'
+        if name:
+            path += f'/{name}'
+
+        return path
+
+    def get_resource(self, kind, name=None, selector=None, field_selector=None):
+        """the equivalent of kubectl get -ojson, returns a CompletedProcess just
+        like kubectl would, or None if kubectl should be used instead"""
+        from requests.exceptions import RequestException
+
+        path = self.tell_path(kind, name)
+        if not path:
+            return None
+        params = {}
+        if selector:
+            params['labelSelector'] = selector
+
+        if field_selector:
+            params['fieldSelector'] = field_selector
+
+        cmd = ['GET', self.endpoint + path]
+        try:
+            res = self.get(path, params=params)
+        except RequestException as e:
+            debug(f'kubernetes api not available, using kubectl instead: {e}')
+            return None
+        if res.ok:
+            return CompletedProcess(cmd, 0, stdout=res.content, stderr=b'')
+        try:
+            status = res.json()
+            reason = status['reason']
+            message = status['message']
+        except (ValueError, KeyError, TypeError):
+            # not a kubernetes Status object, let kubectl deal with it
+            return None
+        # same as what kubectl prints
+        stderr = f'Error from server ({reason}): {message}'.encode('utf-8')
+        return CompletedProcess(cmd, 1, stdout=b'', stderr=stderr)
+
+    def watch_resource(self, kind, resource_version, selector=None, timeout=60):
+        """yield (event type, object) from the watch API, starting from
+        resource_version, until timeout or the server closes the stream"""
+        from requests.exceptions import RequestException
+
+        path = self.tell_path(kind)
+        if not path:
+            return
+        params = {
+            'watch': '1',
+            'resourceVersion': resource_version,
+            'allowWatchBookmarks': 'true',
+            'timeoutSeconds': max(int(timeout), 1),
+        }
+        if selector:
+            params['labelSelector'] = selector
+
+        try:
+            res = self.get(
+                path, params=params, stream=True, timeout=(self.timeout, timeout + 5)
+            )
+            with res:
+                if not res.ok:
+                    return
+                for line in res.iter_lines():
+                    if line:
+                        event = jalo(line)
+                        yield event['type'], event['object']
+        except RequestException as e:
+            debug(f'kubernetes watch interrupted: {e}')
+
+
+@lru_cache(maxsize=None)
+def kubernetes_client(kubeconfig):
+    try:
+        return KubernetesClient(kubeconfig)
+    except (OSError, ValueError) as e:
+        debug(f'not using kubernetes api directly: {e}')
+        return None
+
+
+def tell_kubernetes_client():
+    """client for the kubeconfig that kubectl would use, one per cluster
+    within the same process, so that connections are reused"""
+    if ENV.get('LAIN_KUBECTL_ONLY') == 'true':
+        return None
+    kubeconfig = ENV.get('KUBECONFIG') or expanduser('~/.kube/config')
+    if os.pathsep in kubeconfig:
+        return None
+    return kubernetes_client(realpath(kubeconfig))
@@ -1,42 +1,31 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+from collections import Counter
 from copy import deepcopy
 import shutil
 import sys
 from functools import partial
 from os import getcwd as cwd
 from os.path import basename, dirname, expanduser, isfile, join
+from time import perf_counter, time
 
 import click
 import packaging
-import sentry_sdk
 from click import BadParameter
-from humanfriendly import InvalidTimespan, parse_size, parse_timespan
+from humanfriendly import parse_size, parse_timespan
 
-from lain_cli import __version__
+from lain_cli import IMPORT_STARTED_AT, __version__
 from lain_cli.clusters import SENTRY_DSN
 from lain_cli.gitlab import fetch_chart as fetch_chart_
 from lain_cli.gitlab import validate_repo_name
-from lain_cli.kibana import Kibana
 from lain_cli.lint import (
     suggest_cpu_limits,
     suggest_cpu_requests,
     suggest_memory_limits,
     suggest_memory_requests,
 )
-from lain_cli.prometheus import Prometheus
-from lain_cli.prompt import (
-    build_app_status_command,
-    display_app_status,
-    display_cluster_status,
-    ingress_text,
-    pod_text,
-    top_text,
-)
-from lain_cli.tencent import TencentClient
 from lain_cli.utils import (
-    get_pods,
     CHART_DIR_NAME,
     CHART_TEMPLATE_DIR,
     CHART_VERSION,
@@ -44,6 +33,7 @@ from lain_cli.utils import (
     DOCKER_COMPOSE_FILE_PATH,
     HELM_WEIRD_STATE,
     RECENT_TAGS_COUNT,
+    VM_STATES,
     KVPairType,
     banyun,
     clean_canary_ingress_annotations,
@@ -60,6 +50,8 @@ from lain_cli.utils import (
     ensure_resource_initiated,
     ensure_str,
     error,
+    find_snapshot_item,
+    follow_rollouts,
     find,
     get_app_status,
     get_pod_rc,
@@ -67,13 +59,16 @@ from lain_cli.utils import (
     goodjob,
     helm,
     helm_delete,
+    index_metadata,
     init_done_toast,
     is_inside_cluster,
     is_values_file,
     jalo,
     kubectl,
+    kubectl_version_challenge,
     kubectl_apply,
     kubectl_edit,
+    kubectl_get,
     lain_,
     lain_build,
     lain_meta,
@@ -82,8 +77,15 @@ from lain_cli.utils import (
     make_job_name,
     parse_kubernetes_cpu,
     pick_pod,
+    query_metadata_index,
     rc,
+    report_rollouts,
+    resource_snapshot,
+    restart_deployment,
+    start_profiling,
     stern,
+    tell_age_seconds,
+    tell_bad_pod_reason,
     tell_best_deploy,
     tell_cluster,
     tell_cluster_info,
@@ -91,9 +93,12 @@ from lain_cli.utils import (
     tell_helm_options,
     tell_image,
     tell_image_tag,
+    tell_ingress_hosts,
+    tell_ingress_service_names,
     open_kibana_url,
     tell_kibana_url,
     tell_pod_deploy_name,
+    tell_pod_record,
     tell_registry_client,
     tell_release_image,
     tell_secret,
@@ -112,12 +117,16 @@ from lain_cli.utils import (
     wait_for_pod_up,
     wait_for_svc_up,
     warn,
+    with_context,
     welcome_check,
     yadu,
     yalo,
 )
 from lain_cli.webhook import tell_webhook_client
 
+# time spent importing lain_cli, reported by lain --profile
+IMPORT_DURATION = perf_counter() - IMPORT_STARTED_AT
+
 
 @click.group()
 @click.option('--silent', '-s', is_flag=True, help='log as little text as possible')
@@ -136,14 +145,25 @@ from lain_cli.webhook import tell_webhook_client
     type=click.Choice(CLUSTERS),
     help='run lain use first, and then proceed. use this if you are afraid of accidentally execute command towards the wrong cluster',
 )
+@click.option(
+    '--profile',
+    is_flag=True,
+    envvar='LAIN_PROFILE',
+    help='print a wall time report of imports, external commands, http requests and template rendering on exit',
+)
 @click.pass_context
-def lain(ctx, silent, verbose, ignore_lint, values, use):
+def lain(ctx, silent, verbose, ignore_lint, values, use, profile):
     """DevOps with minimal effort"""
+    start_profiling(ctx, profile=profile, import_duration=IMPORT_DURATION)
     ctx.obj['silent'] = silent
     ctx.obj['verbose'] = verbose
     ctx.obj['ignore_lint'] = ignore_lint
     ctx.obj['extra_values_file'] = values
-    SENTRY_DSN and sentry_sdk.init(SENTRY_DSN, traces_sample_rate=0)
+    if SENTRY_DSN:
+        import sentry_sdk
+
+        sentry_sdk.init(SENTRY_DSN, traces_sample_rate=0)
+
     try:
         ensure_helm_initiated()
         version_challenge()
@@ -167,65 +187,180 @@ def admin():
     is_flag=True,
 )
 def delete_bad_pod(dry_run):
-    jobs = kubectl(
-        'get',
-        'job',
-        '--no-headers',
-        '-ojsonpath={..metadata.name}',
-        capture_output=True,
-    )
-    job_names = tuple(ensure_str(jobs.stdout).split())
-    _, pods = get_pods(show_only_bad_pods=True, check=True)
-
-    def is_job(pod_name):
-        for job_name in job_names:
-            if pod_name.startswith(job_name):
-                return job_name
-
-    for line in pods:
-        pod_name, _, state, *_ = line.split()
-        job_name = is_job(pod_name)
-        if job_name:
-            resource_type = 'job'
-            resource_name = job_name
+    """delete pods that tell_bad_pod_reason complains about, or their jobs if
+    they belong to one"""
+    res, snapshot = resource_snapshot(kinds=['pod', 'job'])
+    if snapshot is None:
+        error(ensure_str(res.stderr), exit=rc(res) or 1)
+    job_names = {job['metadata']['name'] for job in snapshot['job']}
+    plan = {'job': {}, 'pod': {}}
+    for pod in snapshot['pod']:
+        reason = tell_bad_pod_reason(tell_pod_record(pod))
+        if not reason:
+            continue
+        metadata = pod['metadata']
+        owners = [
+            owner['name']
+            for owner in metadata.get('ownerReferences') or []
+            if owner.get('kind') == 'Job'
+        ]
+        job_name = owners[0] if owners else metadata.get('labels', {}).get('job-name')
+        if job_name in job_names:
+            plan['job'].setdefault(job_name, reason)
         else:
-            resource_type = 'pod'
-            resource_name = pod_name
+            plan['pod'][metadata['name']] = reason
 
-        kubectl('delete', resource_type, resource_name, check=False, dry_run=dry_run)
+    if dry_run:
+        for resource_type, reasons in plan.items():
+            for resource_name, reason in sorted(reasons.items()):
+                echo(f'{resource_type}/{resource_name}\t{reason}')
+
+        counts = Counter(
+            reason for reasons in plan.values() for reason in reasons.values()
+        )
+        echo(', '.join(f'{reason}: {n}' for reason, n in sorted(counts.items())))
+        return
+    # a few big kubectl delete calls rather than one for each pod
+    chunk_size = 100
+    for resource_type, reasons in plan.items():
+        names = sorted(reasons)
+        for i in range(0, len(names), chunk_size):
+            kubectl(
+                'delete',
+                resource_type,
+                *names[i : i + chunk_size],
+                '--ignore-not-found',
+                '--wait=false',
+                check=False,
+                timeout=None,
+            )
 
 
 @admin.command()
-def cleanup_registry():
+@click.option(
+    '-j',
+    '--jobs',
+    default=8,
+    type=click.IntRange(min=1),
+    help='talk to the registry using this many connections at the same time',
+)
+@click.option('--dry-run', is_flag=True, help='only tell what would be deleted')
+def cleanup_registry(jobs, dry_run):
+    """delete old images from registry, recent images and images in use are
+    kept. repos are scanned concurrently, and deletion begins as soon as a
+    repo is scanned"""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    from requests.adapters import HTTPAdapter
+    from requests.exceptions import RequestException
+
+    from lain_cli.registry import Registry, RegistryRateLimited
+
     res = kubectl('get', 'po', '-ojsonpath={..image}', capture_output=True)
     running_image_tags = frozenset(
         [image.split(':', 1)[-1] for image in ensure_str(res.stdout).split()]
     )
     protected_tags = {'prepare', 'latest'}
     registry = tell_registry_client()
-    repos = registry.list_repos()
-    for repo in repos:
-        if registry.is_protected_repo(repo):
-            continue
+    if not isinstance(registry, Registry):
+        error(f'cannot cleanup {type(registry).__name__}', exit=1)
+    # scanning and deleting threads share the connections
+    registry.session.mount('http://', HTTPAdapter(pool_maxsize=jobs * 2))
+    repos = [
+        repo for repo in registry.list_repos() if not registry.is_protected_repo(repo)
+    ]
+    summary = {'repos': len(repos), 'old tags': 0, 'deleted': 0, 'failed': 0}
+    errors = (RequestException, RegistryRateLimited)
+
+    def scan(repo, request_pool):
         tags = set(registry.list_tags(repo))
         recent_tags = frozenset(registry.sort_and_filter(tags)[:20])
         ancient_tags = tags - recent_tags - protected_tags - running_image_tags
-        for tag in ancient_tags:
-            res = registry.delete_image(repo, tag)
-            debug(f'delete {repo}:{tag}, {res}')
+        if not ancient_tags:
+            return ancient_tags, set()
+        tags = sorted(tags)
+        digests = dict(
+            zip(
+                tags,
+                request_pool.map(
+                    with_context(partial(registry.tell_digest, repo)), tags
+                ),
+            )
+        )
+        # a manifest may be shared by several tags, delete it only once, and
+        # never when one of its tags is to be kept
+        kept_digests = {digests[tag] for tag in tags if tag not in ancient_tags}
+        ancient_digests = {digests[tag] for tag in ancient_tags} - kept_digests
+        return ancient_tags, ancient_digests - {None}
+
+    with ThreadPoolExecutor(max_workers=jobs) as scan_pool, ThreadPoolExecutor(
+        max_workers=jobs
+    ) as request_pool:
+        # retries are logged by debug, which needs the click context
+        scan_ = with_context(scan)
+        scans = {scan_pool.submit(scan_, repo, request_pool): repo for repo in repos}
+        deletions = {}
+        for i, future in enumerate(as_completed(scans), 1):
+            repo = scans[future]
+            progress = f'[{i}/{len(repos)}] {repo}'
+            try:
+                ancient_tags, digests = future.result()
+            except errors as e:
+                summary['failed'] += 1
+                warn(f'{progress}: cannot scan due to {e}')
+                continue
+            summary['old tags'] += len(ancient_tags)
+            echo(f'{progress}: {len(ancient_tags)} old tags, {len(digests)} manifests')
+            for digest in digests:
+                if dry_run:
+                    echo(f'would delete {repo}@{digest}')
+                    continue
+                future = request_pool.submit(
+                    with_context(registry.delete_digest), repo, digest
+                )
+                deletions[future] = f'{repo}@{digest}'
+
+        for future in as_completed(deletions):
+            try:
+                res = future.result()
+            except errors as e:
+                res = e
+            # 404 means someone else got there first
+            if getattr(res, 'status_code', None) in {202, 404}:
+                summary['deleted'] += 1
+                debug(f'deleted {deletions[future]}')
+            else:
+                summary['failed'] += 1
+                warn(f'cannot delete {deletions[future]} due to {res}')
+
+    echo(', '.join(f'{k}: {v}' for k, v in summary.items()))
 
 
 @admin.command()
 @click.pass_context
 def status(ctx):
+    from lain_cli.prompt import display_cluster_status
+
     ctx.obj['silent'] = True
     display_cluster_status()
 
 
 @admin.command()
+@click.option(
+    '-j',
+    '--jobs',
+    default=1,
+    type=click.IntRange(min=1),
+    help='run on this many containers at the same time',
+)
+@click.option(
+    '--timeout',
+    callback=click_parse_timespan,
+    help='give up on a container after this long, default to no timeout',
+)
 @click.argument('command', nargs=-1)
 @click.pass_context
-def x(ctx, command):
+def x(ctx, jobs, timeout, command):
     """run command on all containers (one for each deployment) within current
     namespace.  only show output when command succeeds
 
@@ -233,39 +368,64 @@ def x(ctx, command):
     examples:
     \b
         lain admin x -- bash -c 'pip3 freeze | grep -i requests'
+        lain admin x -j 16 --timeout 30s -- bash -c 'pip3 freeze | grep -i requests'
     """
-    res = kubectl('get', 'po', '--no-headers', capture_output=True)
+    from concurrent.futures import ThreadPoolExecutor
+
     ctx.obj['silent'] = True
-    deploy_names = set()
-    for line in ensure_str(res.stdout).splitlines():
-        podname, *_ = line.split()
-        deploy_name = tell_pod_deploy_name(podname)
-        if deploy_name in deploy_names:
-            continue
-        deploy_names.add(deploy_name)
-        res = kubectl(
+    _, snapshot = resource_snapshot(kinds=['pod'])
+    if snapshot is None:
+        error('cannot list pods in current namespace', exit=1)
+    podnames = {}
+    for podname in sorted(pod['metadata']['name'] for pod in snapshot['pod']):
+        podnames.setdefault(tell_pod_deploy_name(podname), podname)
+
+    # containers can only share the terminal when running one at a time
+    exec_options = ['-it'] if jobs == 1 else []
+    # may download kubectl, which must not happen in several threads at once
+    kubectl_version_challenge()
+
+    def exec_(podname):
+        return kubectl(
             'exec',
-            '-it',
+            *exec_options,
             podname,
             '--',
             *command,
             check=False,
-            timeout=None,
+            timeout=timeout,
             capture_output=True,
+            silent=True,
         )
-        if rc(res):
-            stderr = ensure_str(res.stderr)
-            # abort execution in the case of network error
-            if 'unable to connect' in stderr.lower() or 'timeout' in stderr:
-                error(stderr, exit=1)
-            continue
-        echo(f'command succeeds for {podname}')
-        echo(res.stdout)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            (podname, executor.submit(exec_, podname)) for podname in podnames.values()
+        ]
+        # collect in submission order so that output is the same for every run
+        for podname, future in futures:
+            res = future.result()
+            if rc(res):
+                stderr = ensure_str(res.stderr)
+                if stderr.startswith('this command reached its'):
+                    warn(f'command timed out for {podname}')
+                    continue
+                # abort execution in the case of network error
+                if 'unable to connect' in stderr.lower() or 'timeout' in stderr:
+                    for _, pending in futures:
+                        pending.cancel()
+
+                    error(stderr, exit=1)
+                continue
+            echo(f'command succeeds for {podname}')
+            echo(res.stdout)
 
 
 @admin.command()
 @click.argument('instance_ids', nargs=-1)
 def stop_cvm(instance_ids):
+    from lain_cli.tencent import TencentClient
+
     client = TencentClient()
     client.turn_(InstanceIds=instance_ids, state='off')
 
@@ -273,16 +433,20 @@ def stop_cvm(instance_ids):
 @admin.command()
 @click.argument('instance_ids', nargs=-1)
 def start_cvm(instance_ids):
+    from lain_cli.tencent import TencentClient
+
     client = TencentClient()
     client.turn_(InstanceIds=instance_ids)
 
 
 @admin.command()
-@click.argument('state', nargs=1, type=click.Choice(TencentClient.VM_STATES))
+@click.argument('state', nargs=1, type=click.Choice(VM_STATES))
 @click.pass_context
 def turn(ctx, state):
     """\b
     turn off currently used cluster, to save money"""
+    from lain_cli.tencent import TencentClient
+
     current_state = wait_for_cluster_up()
     if current_state != state:
         cluster = ctx.obj['cluster']
@@ -297,22 +461,28 @@ def turn(ctx, state):
 
 @admin.command()
 def list_waste():
-    deploy_list = ensure_str(
-        kubectl('get', 'deploy', '--no-headers', capture_output=True).stdout
-    ).splitlines()
+    from lain_cli.prometheus import Prometheus
+
+    deploys = jalo(kubectl_get('deploy', check=True).stdout)['items']
     helm_release_names = set(
         ensure_str(helm('list', '--short', capture_output=True).stdout).split()
     )
     prometheus = Prometheus()
-    for line in deploy_list:
-        name, actual_desired, *_ = line.split()
-        desired = int(actual_desired.split('/')[-1])
+    # a single query if the cluster supports it, otherwise one per deployment
+    cpu_by_deploy = prometheus.cpu_p90_by_deploy()
+    for deploy in deploys:
+        name = deploy['metadata']['name']
+        desired = deploy['spec'].get('replicas', 1)
         if desired < 2:
             continue
         appname, proc_name = name.rsplit('-', 1)
         if appname not in helm_release_names:
             continue
-        cpu_top = prometheus.cpu_p95(appname, proc_name)
+        if cpu_by_deploy is None:
+            cpu_top = prometheus.cpu_p95(appname, proc_name)
+        else:
+            cpu_top = cpu_by_deploy.get(name)
+
         if not cpu_top:
             warn(f'skipping {appname} because cpu data is not available')
             continue
@@ -329,85 +499,91 @@ def list_waste():
 @click.option('--period', default='7d', help='query timespan')
 @click.pass_context
 def list_unused_ingress(ctx, count_below, period):
+    from lain_cli.kibana import Kibana
+
     ctx.obj['silent'] = True
     WEEK = parse_timespan('7d')
-    ing_list = ensure_str(
-        kubectl(
-            'get',
-            'ing',
-            '--no-headers',
-            r'-o=custom-columns=NAME:.metadata.name,HOST:..rules[*].host,CLASS:..annotations.kubernetes\.io/ingress\.class',
-            capture_output=True,
-        ).stdout
-    ).splitlines()
-    kibana = Kibana()
-    svcs = set()
-    for line in ing_list:
-        ing_name, host, ingress_class = line.split()
-        if host.endswith('.lain'):
+    period_s = int(parse_timespan(period))
+    ings = jalo(kubectl_get('ingress', check=True).stdout)['items']
+    svcs = {
+        svc['metadata']['name']: svc
+        for svc in jalo(kubectl_get('svc', check=True).stdout)['items']
+    }
+    pods = jalo(kubectl_get('pod', check=True).stdout)['items']
+    hosts_by_class = {}
+    ing_hosts = []
+    for ing in ings:
+        hosts = tell_ingress_hosts(ing)
+        if not hosts or all(host.endswith('.lain') for host in hosts):
             continue
-        query_count = kibana.count_records_for_host(
-            host, ingress_class=ingress_class, period=period
+        ing_hosts.append((ing, hosts))
+        ingress_class = (
+            ing['metadata'].get('annotations', {}).get('kubernetes.io/ingress.class')
         )
-        if query_count < count_below:
-            stdout = ensure_str(
-                kubectl(
-                    'get',
-                    'ing',
-                    ing_name,
-                    '-ocustom-columns=FOO:..serviceName,BAR:..service.name',
-                    '--no-headers',
-                    capture_output=True,
-                ).stdout
-            )
-            svc_name = [s for s in stdout.split() if s != '<none>'][0]
-            if svc_name in svcs:
-                debug(f'svc already seen, skip: {svc_name}')
-                continue
-            svc_res = kubectl(
-                'get', 'svc', svc_name, '-ojson', capture_output=True, check=False
-            )
-            if rc(svc_res):
-                stderr = ensure_str(svc_res.stderr)
-                if 'not found' in stderr:
-                    debug(f'{ing_name} had bad svc: {svc_name}')
-                    echo(f'k delete ing {ing_name}')
-                    continue
-                error(f'weird error during getting svc: {stderr}', exit=1)
-            else:
-                svcs.add(svc_name)
+        hosts_by_class.setdefault(ingress_class, set()).update(hosts)
 
-            svc = ensure_str(svc_res.stdout)
-            svc_dic = jalo(svc)
-            selectors = ','.join(
-                [f'{k}={v}' for k, v in svc_dic['spec']['selector'].items()]
-            )
-            pods = ensure_str(
-                kubectl(
-                    'get', 'po', '--no-headers', '-l', selectors, capture_output=True
-                ).stdout
-            ).replace('\n', '')
-            try:
-                age = parse_timespan(pods.rsplit(' ', 1)[-1])
-                if age < WEEK:
-                    debug(f'{ing_name} has young pods, skip')
-                    continue
-            except InvalidTimespan:
-                pass
-            if not pods:
-                debug(f'{ing_name} has no pods')
-                echo(f'k delete ing {ing_name}')
-                continue
+    kibana = Kibana()
+    query_counts = {}
+    for ingress_class, hosts in hosts_by_class.items():
+        counts = kibana.count_records_for_hosts(
+            hosts, ingress_class=ingress_class, period=period
+        )
+        if counts is None:
+            warn(f'cannot count requests for {ingress_class} ingresses, skipping')
+            continue
+        query_counts[ingress_class] = counts
 
-            pod_name = pods.split(None, 1)[0]
-            period_s = int(parse_timespan(period))
-            log_res = kubectl(
-                'logs', f'--since={period_s}s', pod_name, capture_output=True
+    seen_svc_names = set()
+    for ing, hosts in ing_hosts:
+        ing_name = ing['metadata']['name']
+        ingress_class = (
+            ing['metadata'].get('annotations', {}).get('kubernetes.io/ingress.class')
+        )
+        if ingress_class not in query_counts:
+            continue
+        counts = query_counts[ingress_class]
+        query_count = sum(counts.get(host, 0) for host in hosts)
+        if query_count >= count_below:
+            continue
+        svc_names = tell_ingress_service_names(ing)
+        svc_name = svc_names[0] if svc_names else None
+        if svc_name in seen_svc_names:
+            debug(f'svc already seen, skip: {svc_name}')
+            continue
+        svc = svcs.get(svc_name)
+        if not svc:
+            debug(f'{ing_name} had bad svc: {svc_name}')
+            echo(f'k delete ing {ing_name}')
+            continue
+        seen_svc_names.add(svc_name)
+        selector = svc['spec'].get('selector') or {}
+        svc_pods = [
+            pod
+            for pod in pods
+            if selector
+            and all(
+                pod['metadata'].get('labels', {}).get(k) == v
+                for k, v in selector.items()
             )
-            if log_res.stdout:
-                debug(f'pod {pod_name} is still printing logs, skip')
-                continue
-            echo(f'{host}\t{query_count}\t{pods}')
+        ]
+        if not svc_pods:
+            debug(f'{ing_name} has no pods')
+            echo(f'k delete ing {ing_name}')
+            continue
+        if any(
+            tell_age_seconds(pod['metadata']['creationTimestamp']) < WEEK
+            for pod in svc_pods
+        ):
+            debug(f'{ing_name} has young pods, skip')
+            continue
+
+        pod_name = svc_pods[0]['metadata']['name']
+        log_res = kubectl('logs', f'--since={period_s}s', pod_name, capture_output=True)
+        if log_res.stdout:
+            debug(f'pod {pod_name} is still printing logs, skip')
+            continue
+        pod_names = ','.join(pod['metadata']['name'] for pod in svc_pods)
+        echo(f'{",".join(hosts)}\t{query_count}\t{pod_names}')
 
 
 @lain.command()
@@ -584,6 +760,14 @@ def init(ctx, appname, force, template_only, commit):
 @click.pass_context
 def status(ctx, simple):
     """view app status"""
+    from lain_cli.prompt import (
+        build_app_status_command,
+        display_app_status,
+        ingress_text,
+        pod_text,
+        top_text,
+    )
+
     # we don't want stderr outputs to mess with our full screen application
     ctx.obj['silent'] = True
     if simple:
@@ -772,8 +956,7 @@ def job(ctx, image_tag, head, force, wait, timeout, context, command):
     if force:
         try_to_cleanup_job(job_name)
     else:
-        res = kubectl('get', 'job', job_name, check=False, capture_output=True)
-        if not rc(res):
+        if find_snapshot_item('job', job_name, appname=appname):
             error(f'{job_name} already exists, maybe someone else is using lain job:')
             error(f'    k logs -f -l job-name={job_name}', clean=False)
             error('if you\'d like to continue anyway, use --force', exit=1)
@@ -797,10 +980,12 @@ def job(ctx, image_tag, head, force, wait, timeout, context, command):
         # 如果发现是在 lain app 目录内运行 lain job, 就选取一个 deploy,
         # 拿出各种 spec 里的信息, 来渲染 job.yaml
         deploy = tell_best_deploy()
-        res = kubectl(
-            'get', 'deploy', f'{appname}-{deploy}', '-ojson', capture_output=True
-        )
-        deploy_spec = jalo(res.stdout)
+        deploy_spec = find_snapshot_item('deployment', f'{appname}-{deploy}', appname)
+        if not deploy_spec:
+            # not labeled as expected, or not there at all, let kubectl tell
+            res = kubectl_get('deploy', f'{appname}-{deploy}', check=True)
+            deploy_spec = jalo(res.stdout)
+
         spec = deploy_spec['spec']['template']['spec']
         hostAliases = spec.get('hostAliases')
         if hostAliases:
@@ -971,9 +1156,21 @@ def use(ctx, cluster, turn):
 
 @lain.command()
 @click.argument('procs_or_appname', nargs=-1)
+@click.option(
+    '--rolling',
+    is_flag=True,
+    help='replace pods gradually like a deploy would, and wait for them to be ready',
+)
+@click.option(
+    '--timeout',
+    default='10m',
+    callback=click_parse_timespan,
+    help='with --rolling, give up waiting after this long, default to 10m',
+)
 @click.pass_context
-def restart(ctx, procs_or_appname):
-    """restart your app using kubectl delete po.
+def restart(ctx, procs_or_appname, rolling, timeout):
+    """restart your app using kubectl delete po, or roll out the deployments
+    again using --rolling.
 
     \b
     examples:
@@ -984,6 +1181,8 @@ def restart(ctx, procs_or_appname):
         lain restart web
         # delete pods of some-other-app, note that name must not collide with proc names
         lain restart some-other-app
+        # restart all procs without dropping capacity, and wait till they're ready
+        lain restart --rolling
     """
     appname = ctx.obj.get('appname')
     procs = procs_or_appname
@@ -994,6 +1193,20 @@ def restart(ctx, procs_or_appname):
         else:
             error('you should run this command in a lain app directory', exit=1)
 
+    if rolling:
+        if procs:
+            deploy_names = [f'{appname}-{proc}' for proc in procs]
+        else:
+            res, snapshot = resource_snapshot(appname, kinds=['deployment'])
+            if snapshot is None:
+                error(ensure_str(res.stderr), exit=rc(res) or 1)
+            deploy_names = sorted(d['metadata']['name'] for d in snapshot['deployment'])
+
+        results = follow_rollouts(
+            deploy_names, timeout=timeout, before=restart_deployment
+        )
+        ctx.exit(int(report_rollouts(results)))
+
     if procs:
         selectors = [f'app.kubernetes.io/instance={appname}-{proc}' for proc in procs]
     else:
@@ -1010,9 +1223,22 @@ def restart(ctx, procs_or_appname):
     is_flag=True,
     help='use the most recent imageTag from registry rather than `lain meta`',
 )
+@click.option(
+    '--wait',
+    is_flag=True,
+    help='wait for the deployments to finish rolling out',
+)
+@click.option(
+    '--timeout',
+    default='10m',
+    callback=click_parse_timespan,
+    help='with --wait, give up waiting after this long, default to 10m',
+)
 @click.pass_context
-def update_image(ctx, procs, deduce):
+def update_image(ctx, procs, deduce, wait, timeout):
     """update, and only update image for some proc"""
+    from concurrent.futures import ThreadPoolExecutor
+
     values = ctx.obj['values']
     choices = set(values['procs'].keys())
     if not procs:
@@ -1035,19 +1261,50 @@ def update_image(ctx, procs, deduce):
         image_tag = tell_image_tag()
 
     image = registry.make_image(image_tag)
-    for proc in procs:
+    resources = {}
+    for proc in sorted(procs):
         resource_type = 'deployment' if proc in values['deployments'] else 'cronjob'
-        res = kubectl(
+        resources[f'{resource_type}/{appname}-{proc}'] = proc
+
+    def set_image(resource):
+        return kubectl(
             'set',
             'image',
-            f'{resource_type}/{appname}-{proc}',
-            f'{proc}={image}',
+            resource,
+            f'{resources[resource]}={image}',
             '--all',
+            capture_output=True,
+            check=False,
         )
+
+    # may download kubectl, which must not happen in several threads at once
+    kubectl_version_challenge()
+    # all procs start rolling out at the same time, rather than one by one
+    started_at = time()
+    with ThreadPoolExecutor(max_workers=min(len(resources), 8)) as executor:
+        results = dict(zip(resources, executor.map(with_context(set_image), resources)))
+
+    failed = False
+    for resource, res in results.items():
         if rc(res):
-            error(
-                'abort due to kubectl failure, if you don\'t understand the above error output, seek help from SA'
-            )
+            failed = True
+            error(f'{resource}: {ensure_str(res.stderr)}')
+        else:
+            echo(ensure_str(res.stdout).rstrip())
+
+    if failed:
+        error(
+            'abort due to kubectl failure, if you don\'t understand the above error output, seek help from SA',
+            exit=1,
+        )
+    if wait:
+        deploy_names = [
+            resource.split('/', 1)[-1]
+            for resource in resources
+            if resource.startswith('deployment/')
+        ]
+        results = follow_rollouts(deploy_names, timeout=timeout, started_at=started_at)
+        ctx.exit(int(report_rollouts(results)))
 
 
 @lain.command()
@@ -1119,52 +1376,51 @@ def rollback(ctx):
 @click.argument('resource')
 @click.option(
     '--annotations',
-    required=True,
     multiple=True,
     type=KVPairType(),
     help='query by annotations',
 )
+@click.option(
+    '--labels',
+    multiple=True,
+    type=KVPairType(),
+    help='query by labels',
+)
+@click.option(
+    '--match',
+    default='any',
+    type=click.Choice(['any', 'all']),
+    help='show resources that match any (the default) or all of the conditions',
+)
 @click.pass_context
-def get(ctx, resource, annotations):
-    """Like kubectl get, but support filtering by annotations.
+def get(ctx, resource, annotations, labels, match):
+    """Like kubectl get, but support filtering by annotations and labels.
 
     \b
     examples:
     \b
         lain admin get pod --annotations prometheus.io/scrape=true
+        lain admin get pod --annotations prometheus.io/scrape=true --labels app=dummy --match all
     """
+    if not annotations and not labels:
+        raise BadParameter('use --annotations or --labels to filter resources')
     ctx.obj['silent'] = True
-    items = kubectl(
+    res = kubectl(
         'get',
         '--all-namespaces',
         resource,
-        '-o=custom-columns=NS:.metadata.namespace,NAME:.metadata.name,:.metadata.annotations',
-        '--no-headers',
+        '-ojson',
         check=True,
         capture_output=True,
     )
-
-    def parse_annotations(s):
-        bracketed = s.strip().removeprefix('map').strip('[]')
-        if bracketed == '<none>':
-            return
-        pairs = bracketed.split()
-        dic = dict([pair.split(':', 1) for pair in pairs])
-        return dic
-
-    for line in ensure_str(items.stdout).splitlines():
-        try:
-            _, _, annotations_part = line.split(None, 2)
-        except ValueError:
-            continue
-        annotations_dic = parse_annotations(annotations_part)
-        if not annotations_dic:
-            continue
-        for k, v in annotations:
-            if annotations_dic.get(k) == v:
-                echo(line)
-            else:
-                debug(line)
+    items = jalo(res.stdout)['items']
+    index = index_metadata(items)
+    predicates = [('annotations', k, v) for k, v in annotations]
+    predicates.extend(('labels', k, v) for k, v in labels)
+    matches = query_metadata_index(index, predicates, match_all=match == 'all')
+    for i in sorted(matches):
+        metadata = items[i]['metadata']
+        echo(f'{metadata.get("namespace", "")}\t{metadata["name"]}')
 
 
 @lain.command()
@@ -1333,8 +1589,15 @@ def set_canary_group(ctx, canary_group_name, abort, final):
         pairs = [('imageTag', image_tag)]
         options = tell_helm_options(pairs, extra='--install')
         helm('upgrade', *options, appname, f'./{CHART_DIR_NAME}')
+        # right after helm upgrade, pods of the previous revision are still
+        # ready, only the rollouts tell when the new pods are serving
+        deploy_names = [
+            f'{appname}-{proc}' for proc in ctx.obj['values'].get('deployments') or {}
+        ]
+        if report_rollouts(follow_rollouts(deploy_names)):
+            error(f'rollout failed, {canary_name} is kept', exit=1)
+
         selector = f'app.kubernetes.io/name={appname}'
-        wait_for_pod_up(selector)
         helm('delete', canary_name)
         wait_res = wait_for_pod_up(selector)
         webhook = tell_webhook_client()
@@ -1379,7 +1642,7 @@ def set_canary_group(ctx, canary_group_name, abort, final):
 @click.option(
     '--tries',
     default=40,
-    help='tries before giving up (will sleep 3s after each try).',
+    help='tries before giving up, each try takes 3s at most.',
 )
 @click.pass_context
 def wait(ctx, appname, tries):
@@ -1397,8 +1660,11 @@ def wait(ctx, appname, tries):
     selector = f'app.kubernetes.io/name={appname}'
     wait_for_pod_up(selector, tries=tries)
     if is_inside_cluster():
-        up = wait_for_svc_up(tries=tries)
-        if not up:
+        res = wait_for_svc_up(tries=tries)
+        for url, duration in res['durations'].items():
+            echo(f'{url} up after {duration:.1f}s')
+
+        if not res['up']:
             error('svc not up, check `lain logs` or `lain status` for clues', exit=1)
 
 
@@ -59,6 +59,26 @@ class Prometheus(RequestClientMixin):
 
         return max([cpu_top, 5])
 
+    def cpu_p90_by_deploy(self):
+        """{deploy name: P90 cpu usage} in a single query, deployments without
+        data are left out. pql_template.cpu_by_deploy must measure the same
+        thing as pql_template.cpu, so it can't be made up here: returns None
+        if it's not configured, use cpu_p95 for each deployment instead"""
+        cluster_info = tell_cluster_info()
+        query_template = cluster_info.get('pql_template', {}).get('cpu_by_deploy')
+        if not query_template:
+            return None
+        q = query_template.format(
+            range=LAIN_LINT_PROMETHEUS_QUERY_RANGE, step=LAIN_LINT_PROMETHEUS_QUERY_STEP
+        )
+        # [{'metric': {'deploy': 'dummy-web'}, 'value': [1595486084.053, '4.99']}]
+        res = self.query(q, timeout=60)
+        return {
+            dic['metric']['deploy']: max([int(float(dic['value'][-1])), 5])
+            for dic in res
+            if 'deploy' in dic['metric']
+        }
+
     def memory_p95(self, appname, proc_name, **kwargs):
         cluster_info = tell_cluster_info()
         query_template = cluster_info.get('pql_template', {}).get('memory_p95')
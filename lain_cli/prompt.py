@@ -6,6 +6,7 @@ from operator import itemgetter
 from subprocess import list2cmdline
 
 import requests
+from click.globals import pop_context, push_context
 from prompt_toolkit.application import Application
 from prompt_toolkit.application.current import get_app
 from prompt_toolkit.key_binding import KeyBindings
@@ -14,11 +15,12 @@ from prompt_toolkit.layout.controls import FormattedTextControl
 from prompt_toolkit.layout.layout import Layout
 
 from lain_cli.utils import (
-    parse_ready,
-    get_pods,
     context,
     ensure_str,
+    format_pod_records,
+    get_pod_records,
     kubectl,
+    kubectl_version_challenge,
     parse_kubernetes_cpu,
     parse_size,
     rc,
@@ -41,57 +43,84 @@ def set_content(k, v):
     CONTENT_VENDERER[k] = v
 
 
+def run_in_executor(func, *args):
+    """run the blocking func in the default executor, so that the event loop
+    (and thus keystrokes) won't freeze while waiting for kubectl or http
+    requests. click keeps its context per thread, so it's pushed into the
+    worker thread as well"""
+    ctx = context()
+
+    def run():
+        push_context(ctx)
+        try:
+            return func(*args)
+        finally:
+            pop_context()
+
+    return asyncio.get_running_loop().run_in_executor(None, run)
+
+
+async def refresh_panel(refresh, key):
+    """a failed refresh is displayed in the panel (keyed by key in
+    CONTENT_VENDERER), rather than stopping the panel from refreshing"""
+    try:
+        await refresh()
+    except Exception as e:
+        set_content(key, f'refresh failed, will retry: {e!r}')
+    get_app().invalidate()
+
+
+async def refresh_periodically(refresh, key, interval):
+    """every panel has its own pace, a slow panel won't hold up the others"""
+    while True:
+        await refresh_panel(refresh, key)
+        await asyncio.sleep(interval)
+
+
 async def refresh_events_text():
+    set_content('event_text', await run_in_executor(events_text))
+
+
+def events_text():
     """display events for weird pods"""
     bad_pods = CONTENT_VENDERER['bad_pods']
     if not bad_pods:
-        CONTENT_VENDERER['event_text'] = 'no weird pods found'
-        return
+        return 'no weird pods found'
     cmd = []
-    for podline in bad_pods[1:]:
-        pod_name, ready_str, status, *_ = podline.split()
-        if status == 'Pending':
+    for record in bad_pods:
+        n_ready, n_all = record.ready
+        if record.reason == 'Pending':
             cmd = [
                 'get',
                 'pod',
-                f'{pod_name}',
+                f'{record.name}',
                 '-ojsonpath={.status.containerStatuses..message}',
             ]
             break
-        if status == 'CrashLoopBackOff' or not parse_ready(ready_str):
-            cmd = ['logs', '--tail=50', f'{pod_name}']
+        if record.reason == 'CrashLoopBackOff' or n_ready != n_all:
+            cmd = ['logs', '--tail=50', f'{record.name}']
             break
 
     if cmd:
         res = kubectl(*cmd, capture_output=True, check=False)
-        CONTENT_VENDERER['event_text'] = ensure_str(res.stdout) or ensure_str(
-            res.stderr
-        )
-        return
+        return ensure_str(res.stdout) or ensure_str(res.stderr)
 
-    CONTENT_VENDERER['event_text'] = 'no weird pods found'
+    return 'no weird pods found'
 
 
 def build_app_status_command():
     ctx = context()
     appname = ctx.obj['appname']
-    pod_cmd = [
-        'get',
-        'pod',
-        '-owide',
-        # add this sort so that abnormal pods appear on top
-        '--sort-by={.status.phase}',
-        '-lapp.kubernetes.io/name={appname}',
-    ]
-    ctx.obj['watch_pod_command'] = pod_cmd
+    # pods are rendered from get_pod_records rather than kubectl get pod, the
+    # columns are the same as -owide though
+    interval = APP_STATUS_REFRESH_INTERVALS['pod']
+    pod_title = f'pods of {appname}, refreshed every {interval}s'
     if tell_pods_count() > 13:
         ctx.obj['too_many_pods'] = True
-        ctx.obj['watch_pod_title'] = '(digested, only showing weird pods) k {}'.format(
-            list2cmdline(pod_cmd)
-        )
+        ctx.obj['watch_pod_title'] = f'{pod_title} (digested, only showing weird pods)'
     else:
         ctx.obj['too_many_pods'] = False
-        ctx.obj['watch_pod_title'] = 'k {}'.format(list2cmdline(pod_cmd))
+        ctx.obj['watch_pod_title'] = pod_title
 
     top_cmd = ['top', 'po', '-l', f'app.kubernetes.io/name={appname}']
     ctx.obj['watch_top_command'] = top_cmd
@@ -107,22 +136,29 @@ def pod_text(too_many_pods=None):
     if too_many_pods is None:
         too_many_pods = ctx.obj['too_many_pods']
 
-    res, pods = get_pods(
-        appname=appname, headers=True, show_only_bad_pods=too_many_pods
+    # the panel has its own refresh interval, don't let snapshots get in the way
+    res, records = get_pod_records(
+        appname=appname, show_only_bad_pods=too_many_pods, fresh=True
     )
     if rc(res):
         return ensure_str(res.stderr)
-    CONTENT_VENDERER['bad_pods'] = pods
-    report = '\n'.join(pods)
+    CONTENT_VENDERER['bad_pods'] = records
+    report = '\n'.join(format_pod_records(records))
     return report
 
 
 async def refresh_pod_text():
-    set_content('pod_text', pod_text())
+    bad_pods = CONTENT_VENDERER['bad_pods']
+    set_content('pod_text', await run_in_executor(pod_text))
+    # events are only looked up when the weird pods change, or on demand
+    if CONTENT_VENDERER['bad_pods'] != bad_pods:
+        get_app().create_background_task(
+            refresh_panel(refresh_events_text, 'event_text')
+        )
 
 
 async def refresh_top_text():
-    set_content('top_text', top_text())
+    set_content('top_text', await run_in_executor(top_text))
 
 
 def kubectl_top_digest(stdout):
@@ -181,7 +217,7 @@ ingress_text_template = template_env.from_string(ingress_text_str)
 
 
 async def refresh_ingress_text():
-    set_content('ingress_text', ingress_text())
+    set_content('ingress_text', await run_in_executor(ingress_text))
 
 
 def ingress_text():
@@ -237,22 +273,32 @@ Win = partial(Window, wrap_lines=True)
 Title = partial(FormattedTextControl, style='fg:GreenYellow')
 
 
+# seconds between refreshes of each panel, the events panel is refreshed
+# when the weird pods change, or when the user presses e
+APP_STATUS_REFRESH_INTERVALS = {
+    'pod': 2,
+    'top': 10,
+    'ingress': 5,
+}
+
+
 async def refresh_content():
-    while True:
-        await asyncio.wait(
-            [
-                refresh_pod_text(),
-                refresh_ingress_text(),
-                refresh_events_text(),
-                refresh_top_text(),
-            ]
-        )
-        get_app().invalidate()
-        await asyncio.sleep(0.1)
+    intervals = APP_STATUS_REFRESH_INTERVALS
+    await asyncio.gather(
+        refresh_periodically(refresh_pod_text, 'pod_text', intervals['pod']),
+        refresh_periodically(refresh_top_text, 'top_text', intervals['top']),
+        refresh_periodically(
+            refresh_ingress_text, 'ingress_text', intervals['ingress']
+        ),
+        refresh_panel(refresh_events_text, 'event_text'),
+    )
 
 
 def build_app_status():
     ctx = context()
+    # panels call kubectl in several threads at once, only one of them
+    # should download it
+    kubectl_version_challenge()
     build_app_status_command()
     # building pods container
     pod_text_control = FormattedTextControl(text=lambda: CONTENT_VENDERER['pod_text'])
@@ -289,7 +335,9 @@ def build_app_status():
         [
             Win(
                 height=1,
-                content=Title('events and messages for pods in weird states'),
+                content=Title(
+                    'events and messages for pods in weird states (press e to refresh)'
+                ),
             ),
             events_window,
         ]
@@ -319,6 +367,12 @@ def build_app_status():
     def _(event):
         event.app.exit()
 
+    @kb.add('e')
+    def _(event):
+        event.app.create_background_task(
+            refresh_panel(refresh_events_text, 'event_text')
+        )
+
     app = Application(
         key_bindings=kb,
         layout=Layout(root_container),
@@ -345,33 +399,51 @@ def build_cluster_status_command():
 
 
 async def refresh_bad_pod_text():
+    set_content('pod_text', await run_in_executor(bad_pod_text))
+
+
+def bad_pod_text():
     ctx = context()
     cmd = ctx.obj['watch_bad_pod_command']
     res = kubectl(*cmd, timeout=2, capture_output=True, check=False)
-    set_content('pod_text', ensure_str(res.stdout) or ensure_str(res.stderr))
+    return ensure_str(res.stdout) or ensure_str(res.stderr)
 
 
 async def refresh_bad_node_text():
+    set_content('node_text', await run_in_executor(bad_node_text))
+
+
+def bad_node_text():
     ctx = context()
     cmd = ctx.obj['watch_node_command'] = ['get', 'node']
     res = kubectl(*cmd, timeout=2, capture_output=True, check=False)
     if rc(res):
-        return set_content('node_text', ensure_str(res.stderr))
+        return ensure_str(res.stderr)
     all_nodes = ensure_str(res.stdout)
     bad_nodes = [line for line in all_nodes.splitlines() if ' Ready ' not in line]
     report = '\n'.join(bad_nodes)
-    set_content('node_text', report)
+    return report
+
+
+CLUSTER_STATUS_REFRESH_INTERVALS = {
+    'pod': 2,
+    'node': 10,
+}
 
 
 async def refresh_admin_content():
-    while True:
-        await asyncio.wait([refresh_bad_pod_text(), refresh_bad_node_text()])
-        get_app().invalidate()
-        await asyncio.sleep(0.1)
+    intervals = CLUSTER_STATUS_REFRESH_INTERVALS
+    await asyncio.gather(
+        refresh_periodically(refresh_bad_pod_text, 'pod_text', intervals['pod']),
+        refresh_periodically(refresh_bad_node_text, 'node_text', intervals['node']),
+    )
 
 
 def build_cluster_status():
     ctx = context()
+    # panels call kubectl in several threads at once, only one of them
+    # should download it
+    kubectl_version_challenge()
     build_cluster_status_command()
     # building pods container
     bad_pod_text_control = FormattedTextControl(
@@ -1,6 +1,39 @@
-from tenacity import retry, stop_after_attempt, wait_fixed
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential,
+)
 
-from lain_cli.utils import RegistryUtils, RequestClientMixin, tell_cluster_info
+from lain_cli.utils import (
+    RegistryUtils,
+    RequestClientMixin,
+    debug,
+    tell_cluster_info,
+    traced_session,
+)
+
+# registries answer these when asked too much at once
+RATE_LIMITED_STATUS = frozenset((429, 503))
+
+
+class RegistryRateLimited(Exception):
+    def __init__(self, res):
+        super().__init__(f'{res.status_code} from {res.url}')
+        try:
+            self.retry_after = float(res.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            self.retry_after = None
+
+
+def wait_rate_limited(retry_state):
+    """back off exponentially, or for as long as the registry asked"""
+    e = retry_state.outcome.exception()
+    retry_after = getattr(e, 'retry_after', None)
+    if retry_after is not None:
+        debug(f'rate limited, retry after {retry_after}s')
+        return retry_after
+    return wait_exponential(multiplier=1, min=2, max=30)(retry_state)
 
 
 class Registry(RequestClientMixin, RegistryUtils):
@@ -13,25 +46,64 @@ class Registry(RequestClientMixin, RegistryUtils):
 
         self.host = host
         self.endpoint = f'http://{host}'
+        self.session = traced_session()
+
+    @staticmethod
+    def check_rate_limit(res):
+        """only for the methods that retry on RegistryRateLimited"""
+        if res.status_code in RATE_LIMITED_STATUS:
+            raise RegistryRateLimited(res)
+        return res
 
     def list_repos(self):
         path = '/v2/_catalog'
         responson = self.get(path, params={'n': 9999}, timeout=90).json()
         return responson.get('repositories', [])
 
-    @retry(reraise=True, wait=wait_fixed(2), stop=stop_after_attempt(6))
-    def delete_image(self, repo, tag=None):
+    def has_tag(self, repo, tag):
+        # only the manifest of a single tag, rather than listing all tags
+        try:
+            return self.head_manifest(repo, tag).ok
+        except RegistryRateLimited:
+            return super().has_tag(repo, tag)
+
+    @retry(
+        reraise=True,
+        wait=wait_rate_limited,
+        stop=stop_after_attempt(3),
+        retry=retry_if_exception_type(RegistryRateLimited),
+    )
+    def head_manifest(self, repo, tag):
+        return self.check_rate_limit(self.head(f'/v2/{repo}/manifests/{tag}'))
+
+    @retry(reraise=True, wait=wait_rate_limited, stop=stop_after_attempt(6))
+    def tell_digest(self, repo, tag):
         path = '/v2/{}/manifests/{}'.format(repo, tag)
-        headers = self.head(path).headers
-        docker_content_digest = headers.get('Docker-Content-Digest')
+        headers = self.check_rate_limit(self.head(path)).headers
+        return headers.get('Docker-Content-Digest')
+
+    @retry(reraise=True, wait=wait_rate_limited, stop=stop_after_attempt(6))
+    def delete_digest(self, repo, digest):
+        path = f'/v2/{repo}/manifests/{digest}'
+        res = self.delete(path, timeout=20)  # 不知道为啥删除操作就是很慢, 只好在这里单独放宽
+        return self.check_rate_limit(res)
+
+    def delete_image(self, repo, tag=None):
+        docker_content_digest = self.tell_digest(repo, tag)
         if not docker_content_digest:
             return
-        path = f'/v2/{repo}/manifests/{docker_content_digest}'
-        return self.delete(path, timeout=20)  # 不知道为啥删除操作就是很慢, 只好在这里单独放宽
+        return self.delete_digest(repo, docker_content_digest)
 
+    @retry(
+        reraise=True,
+        wait=wait_rate_limited,
+        stop=stop_after_attempt(6),
+        retry=retry_if_exception_type(RegistryRateLimited),
+    )
     def list_tags(self, repo_name, n=None, timeout=90):
         path = f'/v2/{repo_name}/tags/list'
-        responson = self.get(path, params={'n': 99999}, timeout=timeout).json()
+        res = self.get(path, params={'n': 99999}, timeout=timeout)
+        responson = self.check_rate_limit(res).json()
         if 'tags' not in responson:
             return []
         tags = responson.get('tags') or []
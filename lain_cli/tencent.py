@@ -9,6 +9,7 @@ from tencentcloud.tcr.v20190924 import models as tcr_models
 from tencentcloud.tcr.v20190924.tcr_client import TcrClient
 
 from lain_cli.utils import (
+    VM_STATES,
     RegistryUtils,
     debug,
     error,
@@ -21,7 +22,7 @@ from lain_cli.utils import (
 
 class TencentClient(RegistryUtils):
 
-    VM_STATES = {'on', 'off'}
+    VM_STATES = VM_STATES
 
     def __init__(self, registry=None, secret_id=None, secret_key=None):
         if not all([registry, secret_id, secret_key]):
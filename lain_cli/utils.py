@@ -1,4 +1,3 @@
-import asyncio
 import tarfile
 import base64
 import inspect
@@ -12,22 +11,28 @@ import shutil
 import stat
 import subprocess
 import sys
+import threading
+import traceback
+from collections import namedtuple
 from collections.abc import Mapping
 from contextlib import contextmanager, suppress
 from copy import deepcopy
-from functools import lru_cache
+from datetime import datetime, timezone
+from functools import lru_cache, wraps
 from hashlib import blake2b
 from inspect import cleandoc
+from io import StringIO
 from numbers import Number
+from operator import itemgetter
 from os import getcwd as cwd
 from os import readlink, remove
 from os.path import abspath, basename, dirname, expanduser, isdir, isfile, join
 from tempfile import NamedTemporaryFile, TemporaryDirectory
-from time import sleep
+from time import perf_counter, sleep, time
 
 import click
-import requests
 from click import BadParameter
+from click.globals import pop_context, push_context
 from humanfriendly import (
     CombinedUnit,
     SizeUnit,
@@ -35,17 +40,11 @@ from humanfriendly import (
     parse_timespan,
     round_number,
 )
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, Template
 from marshmallow import INCLUDE, Schema, ValidationError, post_load, validates
 from marshmallow.fields import Dict, Function, Int, List, Nested, Raw, Str
 from marshmallow.validate import OneOf
 from packaging import version
-from pip._internal.index.collector import LinkCollector
-from pip._internal.index.package_finder import PackageFinder
-from pip._internal.models.search_scope import SearchScope
-from pip._internal.models.selection_prefs import SelectionPreferences
-from pip._internal.network.session import PipSession
-from requests.exceptions import RequestException
 from ruamel import yaml
 
 from lain_cli import __version__
@@ -57,17 +56,38 @@ CLI_DIR = dirname(abspath(__file__))
 TEMPLATE_DIR = join(CLI_DIR, 'templates')
 CHART_TEMPLATE_DIR = join(CLI_DIR, 'chart_template')
 INTERNAL_CLUSTER_VALUES_DIR = join(CLI_DIR, 'cluster_values')
+# lain --profile records (phase, detail, start, duration) into this
+PROFILE = {'enabled': False, 'records': []}
+
+
+class ProfiledTemplate(Template):
+    def render(self, *args, **kwargs):
+        with profile_phase('template', self.name or '<string>'):
+            return super().render(*args, **kwargs)
+
+
 template_env = Environment(
     trim_blocks=True,
     lstrip_blocks=True,
     loader=FileSystemLoader([CHART_TEMPLATE_DIR, TEMPLATE_DIR]),
     extensions=['jinja2.ext.loopcontrols'],
 )
+template_env.template_class = ProfiledTemplate
 CHART_DIR_NAME = 'chart'
 CHART_VERSION = version.parse('0.1.9')
 ENV = os.environ.copy()
 LOOKOUT_ENV = {'http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROXY'}
 LAIN_EXBIN_PREFIX = ENV.get('LAIN_EXBIN_PREFIX') or '/usr/local/bin'
+LAIN_CACHE_DIR = ENV.get('LAIN_CACHE_DIR') or expanduser('~/.cache/lain')
+LAIN_TRACE_FILE = ENV.get('LAIN_TRACE_FILE')
+VERSION_CHALLENGE_CACHE = 'version-challenge.json'
+TOOL_VERSION_CACHE = 'tool-versions.json'
+HELM_VALUES_CACHE_DIR = 'values'
+HELM_VALUES_CACHE_SIZE = 64
+# how long a pypi lookup result stays fresh, set to 0 to query on every run
+VERSION_CHALLENGE_TTL = int(
+    parse_timespan(ENV.get('LAIN_VERSION_CHALLENGE_TTL') or '1h')
+)
 HELM_MIN_VERSION_STR = 'v3.6.3'
 HELM_MIN_VERSION = version.parse(HELM_MIN_VERSION_STR)
 STERN_MIN_VERSION_STR = '1.11.0'
@@ -86,6 +106,8 @@ BUILD_STAGES = {'prepare', 'build', 'release'}
 PROTECTED_REPO_KEYWORDS = ('centos',)
 RECENT_TAGS_COUNT = 10
 BIG_DEPLOY_REPLICA_COUNT = 3
+# cvm power states, for lain admin turn
+VM_STATES = ('on', 'off')
 INGRESS_CANARY_ANNOTATIONS = {
     'nginx.ingress.kubernetes.io/canary-by-header',
     'nginx.ingress.kubernetes.io/canary-by-header-value',
@@ -150,6 +172,25 @@ def context(silent=False):
     return click.get_current_context(silent=silent)
 
 
+def with_context(func):
+    """click keeps its context per thread, wrap func with this before handing
+    it to a thread pool, so that the worker threads see the same context
+    (silent, verbose, etc) as the calling thread"""
+    ctx = context(silent=True)
+    if not ctx:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        push_context(ctx)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            pop_context()
+
+    return wrapper
+
+
 def excall(s, silent=None):
     """lain cli often calls other cli, might wanna notify the user what's being
     run"""
@@ -166,6 +207,118 @@ def excall(s, silent=None):
     click.echo(click.style(s, fg='bright_yellow'), err=True)
 
 
+def record_phase(phase, detail, started_at, duration):
+    """started_at is a unix timestamp, duration in seconds"""
+    if PROFILE['enabled']:
+        PROFILE['records'].append((phase, detail, started_at, duration))
+
+    if LAIN_TRACE_FILE:
+        write_trace_event(
+            {
+                'name': detail or phase,
+                'cat': phase,
+                'ph': 'X',
+                'ts': int(started_at * 1e6),
+                'dur': int(duration * 1e6),
+                'pid': os.getpid(),
+                'tid': threading.get_native_id(),
+            }
+        )
+
+
+@contextmanager
+def profile_phase(phase, detail=''):
+    """record wall time for lain --profile and LAIN_TRACE_FILE, can be used
+    as decorator as well"""
+    if not PROFILE['enabled'] and not LAIN_TRACE_FILE:
+        yield
+        return
+    started_at = time()
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase, detail, started_at, perf_counter() - start)
+
+
+def start_profiling(ctx, profile=False, import_duration=0):
+    """turn on lain --profile and LAIN_TRACE_FILE for this invocation, nested
+    lain_ calls share the report and trace of the outermost invocation"""
+    fresh = False
+    if profile and not PROFILE['enabled']:
+        PROFILE['enabled'] = fresh = True
+        ctx.call_on_close(print_profile_report)
+
+    if LAIN_TRACE_FILE:
+        fresh = start_tracing() or fresh
+
+    if fresh:
+        record_phase('imports', 'lain_cli', time() - import_duration, import_duration)
+
+    ctx.with_resource(profile_phase('command', f'lain {ctx.invoked_subcommand}'))
+
+
+def start_tracing():
+    """the outermost lain process starts a new trace file, child processes
+    inherit LAIN_TRACE_PARENT and append to it. the file is in the chrome
+    trace event format, without the optional closing bracket"""
+    pid = str(os.getpid())
+    parent = ENV.get('LAIN_TRACE_PARENT')
+    if parent == pid:
+        return False
+    if not parent:
+        with open(LAIN_TRACE_FILE, 'w') as f:
+            f.write('[\n')
+
+    os.environ['LAIN_TRACE_PARENT'] = ENV['LAIN_TRACE_PARENT'] = pid
+    write_trace_event(
+        {
+            'name': 'process_name',
+            'ph': 'M',
+            'pid': os.getpid(),
+            'args': {'name': subprocess.list2cmdline(sys.argv)},
+        }
+    )
+    return True
+
+
+def write_trace_event(event):
+    # small appends are atomic, so concurrent lain processes won't
+    # interleave their lines
+    with open(LAIN_TRACE_FILE, 'a') as f:
+        f.write(jadu(event) + ',\n')
+
+
+profile_report_str = '''{{ '%-21s %6s %9s %9s' | format('phase', 'calls', 'total', 'max') }}
+{% for phase, durations in phases %}
+{{ '%-21s %6d %8.3fs %8.3fs' | format(phase, durations | length, durations | sum, durations | max) }}
+{% endfor %}
+
+{% for phase, detail, _, duration in records %}
+{{ '%8.3fs  %-21s %s' | format(duration, phase, detail) }}
+{% endfor %}
+'''
+
+
+def print_profile_report():
+    """sorted summary of everything recorded by profile_phase, nested
+    phases (e.g. subprocess calls made by version_challenge) are counted
+    in their parents as well"""
+    records = PROFILE['records']
+    PROFILE.update({'enabled': False, 'records': []})
+    if not records:
+        return
+    grouped = {}
+    for phase, _, _, duration in records:
+        grouped.setdefault(phase, []).append(duration)
+
+    phases = sorted(grouped.items(), key=lambda t: sum(t[1]), reverse=True)
+    records = sorted(records, key=itemgetter(3), reverse=True)
+    template = template_env.from_string(profile_report_str)
+    report = template.render(phases=phases, records=records)
+    click.echo(report, err=True)
+
+
 def ensure_str(s):
     try:
         return s.decode('utf-8')
@@ -251,6 +404,37 @@ def tell_pod_deploy_name(s):
     return s.rsplit('-', 2)[0]
 
 
+def tell_ingress_hosts(ing):
+    """hosts of an ingress object
+
+    >>> tell_ingress_hosts({'spec': {'rules': [{'host': 'dummy.example.com'}, {}]}})
+    ['dummy.example.com']
+    """
+    return [rule['host'] for rule in ing['spec'].get('rules') or [] if rule.get('host')]
+
+
+def tell_ingress_service_names(ing):
+    """backend service names of an ingress object, supports both
+    networking.k8s.io/v1 and the older v1beta1 ingress
+
+    >>> v1 = {'backend': {'service': {'name': 'dummy-web'}}}
+    >>> v1beta1 = {'backend': {'serviceName': 'dummy-worker'}}
+    >>> tell_ingress_service_names({'spec': {'rules': [{'http': {'paths': [v1, v1beta1]}}]}})
+    ['dummy-web', 'dummy-worker']
+    """
+    names = []
+    for rule in ing['spec'].get('rules') or []:
+        for path in (rule.get('http') or {}).get('paths') or []:
+            backend = path.get('backend') or {}
+            name = backend.get('serviceName') or (backend.get('service') or {}).get(
+                'name'
+            )
+            if name and name not in names:
+                names.append(name)
+
+    return names
+
+
 def tell_ingress_urls():
     ctx = context()
     cluster = ctx.obj['cluster']
@@ -289,78 +473,173 @@ def tell_ingress_urls():
     return list(part1) + list(part2)
 
 
-def parse_ready(ready_str):
-    """
-    >>> parse_ready('0/1')
-    False
-    >>> parse_ready('1/1')
+# a compact summary of pod json, ready is (ready containers, all containers),
+# reason is what kubectl shows in the STATUS column
+PodRecord = namedtuple('PodRecord', 'name ready phase restarts reason node ip created')
+
+
+def tell_pod_record(pod):
+    metadata = pod['metadata']
+    status = pod.get('status') or {}
+    restarts = sum(
+        s.get('restartCount', 0) for s in status.get('containerStatuses') or []
+    )
+    return PodRecord(
+        name=metadata['name'],
+        ready=tell_pod_ready(pod),
+        phase=status.get('phase'),
+        restarts=restarts,
+        reason=tell_pod_status(pod),
+        node=(pod.get('spec') or {}).get('nodeName'),
+        ip=status.get('podIP'),
+        created=metadata.get('creationTimestamp'),
+    )
+
+
+def tell_bad_pod_reason(record):
+    """why this pod needs attention, None for healthy pods
+
+    >>> record = PodRecord('x', (1, 1), 'Running', 0, 'Running', 'node-1', None, None)
+    >>> tell_bad_pod_reason(record) is None
     True
+    >>> tell_bad_pod_reason(record._replace(ready=(0, 1), reason='CrashLoopBackOff'))
+    'abnormal'
+    >>> tell_bad_pod_reason(record._replace(ready=(0, 1)))
+    'not ready'
+    >>> tell_bad_pod_reason(record._replace(restarts=11))
+    'restarts'
     """
-    left, right = ready_str.split('/')
-    if left != right:
-        return False
-    return True
+    if record.reason == 'Completed':
+        # job pods will be ignored
+        return None
+    if record.reason not in {'Running', 'Terminating', 'ContainerCreating'}:
+        return 'abnormal'
+    n_ready, n_all = record.ready
+    if n_ready != n_all:
+        return 'not ready'
+    if record.restarts > 10:
+        # 本来时不时就会重启节点, 造成容器重启, 因此设置个小阈值, 过滤噪声
+        return 'restarts'
+    return None
+
+
+def tell_age_seconds(created, now=None):
+    """seconds since a kubernetes timestamp, like metadata.creationTimestamp
+
+    >>> now = datetime(2021, 1, 2, tzinfo=timezone.utc)
+    >>> tell_age_seconds('2021-01-01T23:59:00Z', now=now)
+    60.0
+    """
+    created_at = datetime.strptime(created, '%Y-%m-%dT%H:%M:%SZ').replace(
+        tzinfo=timezone.utc
+    )
+    return ((now or datetime.now(timezone.utc)) - created_at).total_seconds()
 
 
-def get_pods(appname=None, headers=False, show_only_bad_pods=None, check=False):
-    cmd = [
-        'get',
-        'pod',
-        '-o=wide',
+def tell_age(created, now=None):
+    """the AGE column of kubectl get
+
+    >>> now = datetime(2021, 1, 2, 6, 6, tzinfo=timezone.utc)
+    >>> tell_age('2021-01-02T06:05:15Z', now=now)
+    '45s'
+    >>> tell_age('2021-01-02T00:00:00Z', now=now)
+    '6h6m'
+    >>> tell_age('2020-12-30T00:00:00Z', now=now)
+    '3d6h'
+    """
+    if not created:
+        return '<unknown>'
+    seconds = int(tell_age_seconds(created, now=now))
+    minutes, hours, days = seconds // 60, seconds // 3600, seconds // 86400
+    if seconds < 120:
+        return f'{seconds}s'
+    if minutes < 10:
+        return f'{minutes}m{seconds % 60}s' if seconds % 60 else f'{minutes}m'
+    if hours < 3:
+        return f'{minutes}m'
+    if hours < 8:
+        return f'{hours}h{minutes % 60}m' if minutes % 60 else f'{hours}h'
+    if days < 2:
+        return f'{hours}h'
+    if days < 8:
+        return f'{days}d{hours % 24}h' if hours % 24 else f'{days}d'
+    return f'{days}d'
+
+
+def format_pod_records(records):
+    """render records like kubectl get pod -owide, header included"""
+    rows = [('NAME', 'READY', 'STATUS', 'RESTARTS', 'AGE', 'IP', 'NODE')]
+    now = datetime.now(timezone.utc)
+    for record in records:
+        rows.append(
+            (
+                record.name,
+                '{}/{}'.format(*record.ready),
+                record.reason,
+                str(record.restarts),
+                tell_age(record.created, now=now),
+                record.ip or '<none>',
+                record.node or '<none>',
+            )
+        )
+
+    widths = [max(len(cell) for cell in column) for column in zip(*rows)]
+    return [
+        '   '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+        for row in rows
     ]
-    if appname:
-        cmd.append(f'-lapp.kubernetes.io/name={appname}')
-
-    res = kubectl(*cmd, capture_output=True, check=check)
-    pods = ensure_str(res.stdout).splitlines()
-    if not show_only_bad_pods:
-        if headers:
-            return res, pods
-        return res, pods[1:]
-    header = pods.pop(0)
-    bad_pods = []
-    for line in pods:
-        pod_name, _, state, *_ = line.split()
-        for podline in pods[1:]:
-            # ['deploy-x-x', '1/1', 'Running', '0', '6h6m', '192.168.0.13', 'node-1', '<none>', '1/1']
-            _, ready_str, status, restarts, *_ = podline.split()
-            if status == 'Completed':
-                # job pods will be ignored
-                continue
-            if not parse_ready(ready_str):
-                bad_pods.append(podline)
-                continue
-            if status not in {'Running', 'Terminating', 'ContainerCreating'}:
-                # 状态异常的 pods 是我们最为关心的, 因此塞到头部方便取用
-                bad_pods.insert(1, podline)
-                continue
-            if int(restarts) > 10:
-                # 本来时不时就会重启节点, 造成容器重启, 因此设置个小阈值, 过滤噪声
-                bad_pods.append(podline)
-                continue
 
+
+def get_pod_records(appname=None, show_only_bad_pods=None, check=False, fresh=False):
+    """returns (res, [PodRecord]), bad pods are the ones that
+    tell_bad_pod_reason complains about, abnormal ones first"""
+    res, snapshot = resource_snapshot(appname, kinds=['pod'], fresh=fresh)
+    if snapshot is None:
+        code = rc(res)
+        if code and check:
+            error(res.stderr, exit=code)
+        return res, []
+    records = [tell_pod_record(pod) for pod in snapshot['pod']]
+    if show_only_bad_pods:
+        reasons = {record: tell_bad_pod_reason(record) for record in records}
+        records = sorted(
+            (record for record in records if reasons[record]),
+            # 状态异常的 pods 是我们最为关心的, 因此塞到头部方便取用
+            key=lambda record: reasons[record] != 'abnormal',
+        )
+
+    return res, records
+
+
+def get_pods(appname=None, headers=False, show_only_bad_pods=None, check=False):
+    res, records = get_pod_records(
+        appname=appname, show_only_bad_pods=show_only_bad_pods, check=check
+    )
+    pods = format_pod_records(records)
     if headers:
-        return res, [header] + bad_pods
-    return res, bad_pods
+        return res, pods
+    return res, pods[1:]
 
 
 def pick_pod(deploy_name=None, phase=None, containerStatuses=None):
     ctx = context()
     appname = ctx.obj['appname']
-    cmd = ['get', 'pod', '-o=json']
+    # all pods in the snapshot belong to appname already
+    selector = None
     if deploy_name:
-        cmd.extend(['-l', f'app.kubernetes.io/instance={appname}-{deploy_name}'])
-    else:
-        cmd.extend(['-l', f'app.kubernetes.io/name={appname}'])
+        selector = f'app.kubernetes.io/instance={appname}-{deploy_name}'
 
-    if phase:
-        cmd.extend([f'--field-selector=status.phase=={phase}'])
-
-    res = kubectl(*cmd, capture_output=True, check=False)
-    stdout = res.stdout
-    if not stdout or rc(res):
+    _, snapshot = resource_snapshot(appname, kinds=['pod'])
+    if snapshot is None:
         return
-    responson = jalo(res.stdout)
+    responson = {
+        'items': [
+            item
+            for item in snapshot['pod']
+            if match_selector(item['metadata'].get('labels'), selector)
+            and (not phase or item['status'].get('phase') == phase)
+        ]
+    }
     if containerStatuses:
         if not isinstance(containerStatuses, set):
             containerStatuses = {containerStatuses}
@@ -491,10 +770,27 @@ def template_update_toast():
     goodjob(template_update_done_str)
 
 
+def traced_session():
+    """requests.Session for http clients that don't use RequestClientMixin,
+    so that they show up in lain --profile and LAIN_TRACE_FILE as well"""
+    import requests
+
+    def record_response(res, *args, **kwargs):
+        duration = res.elapsed.total_seconds()
+        detail = f'{res.request.method} {res.url}'
+        record_phase('request', detail, time() - duration, duration)
+
+    session = requests.Session()
+    session.hooks['response'].append(record_response)
+    return session
+
+
 class RequestClientMixin:
     endpoint = None
     headers = {}
     timeout = 5
+    # set a requests.Session to keep connections alive
+    session = None
 
     def request(self, method, path=None, params=None, data=None, **kwargs):
         if not path:
@@ -504,10 +800,14 @@ class RequestClientMixin:
         else:
             raise ValueError('no endpoint specified')
 
+        import requests
+
         kwargs.setdefault('timeout', self.timeout)
-        res = requests.request(
-            method, url, headers=self.headers, params=params, data=data, **kwargs
-        )
+        with profile_phase('request', f'{method} {url}'):
+            res = (self.session or requests).request(
+                method, url, headers=self.headers, params=params, data=data, **kwargs
+            )
+
         return res
 
     def post(self, path=None, **kwargs):
@@ -552,6 +852,10 @@ class RegistryUtils:
             return sor[:n]
         return sor
 
+    def has_tag(self, repo, tag):
+        """registries that can look up a single tag should override this"""
+        return tag in (self.list_tags(repo) or [])
+
     def make_image(self, tag):
         ctx = context()
         repo = ctx.obj['appname']
@@ -632,9 +936,7 @@ def tell_secret(secret_name, init='env'):
     """return Kubernetes secret object in python dict, all b64decoded.
     If secret doesn't exist, create one first, and with some example content"""
 
-    res = kubectl(
-        'get', 'secret', '-oyaml', secret_name, capture_output=True, check=False
-    )
+    res = kubectl_get('secret', secret_name)
     if code := rc(res):
         stderr = ensure_str(res.stderr)
         if 'not found' in stderr:
@@ -642,7 +944,7 @@ def tell_secret(secret_name, init='env'):
             return tell_secret(secret_name, init=init)
         error(f'weird error: {stderr}', exit=code)
 
-    dic = yalo(res.stdout)
+    dic = jalo(res.stdout)
     clean_kubernetes_manifests(dic)
     dic.setdefault('data', {})
     for fname, s in dic['data'].items():
@@ -755,7 +1057,7 @@ def kubectl_apply(
     debug('dumping kubernetes manifest:')
     debug(dic)
     f = NamedTemporaryFile(suffix='.yaml')
-    yadu(dic, f)
+    yadu(dic, f, fast=True)
     f.seek(0)
     validate = jadu(validate)
     res = kubectl(
@@ -913,14 +1215,15 @@ def tell_image_tag(image_tag=None):
     if not registry:
         return image_tag
     appname = ctx.obj['appname']
-    existing_tags = registry.list_tags(appname) or []
-    if image_tag not in existing_tags:
+    if not registry.has_tag(appname, image_tag):
         # when using lain deploy --build without using --set imageTag=xxx, we
         # can build the requested image for the user
         if ctx.obj['build_jit'] and build_jit_challenge(image_tag):
             lain_('build', '--push')
             return image_tag
 
+        # all tags are only needed for suggestions
+        existing_tags = registry.list_tags(appname) or []
         recent_tags = RegistryUtils.sort_and_filter(existing_tags)[:RECENT_TAGS_COUNT]
         if not recent_tags:
             warn(f'no recent tags found in existing_tags: {existing_tags}')
@@ -949,25 +1252,67 @@ def tell_image_tag(image_tag=None):
     return image_tag
 
 
-def lain_(*args, exit=None, **kwargs):
+def lain_(*args, exit=None, isolate=False, **kwargs):
+    """run a lain sub-command. this happens in-process with a fresh ctx.obj,
+    unless isolate=True, LAIN_ISOLATE=true, or subprocess options (like
+    capture_output) are passed, in which case a new lain process is spawned"""
     ctx = context()
     extra_values_file = ctx.obj['extra_values_file']
     if extra_values_file:
         args = ['--values', extra_values_file.name, *args]
 
-    cmd = ['lain', *args]
     kwargs.setdefault('check', True)
-    if ctx.obj['ignore_lint']:
-        kwargs.setdefault('env', ENV)
-        kwargs['env']['LAIN_IGNORE_LINT'] = 'true'
+    isolate = isolate or ENV.get('LAIN_ISOLATE') == 'true' or set(kwargs) != {'check'}
+    cmd = ['lain', *args]
+    with profile_phase('lain_', subprocess.list2cmdline(cmd)):
+        if isolate:
+            if ctx.obj['ignore_lint']:
+                kwargs.setdefault('env', ENV)
+                kwargs['env']['LAIN_IGNORE_LINT'] = 'true'
+
+            completed = subprocess_run(cmd, **kwargs)
+        else:
+            if ctx.obj['ignore_lint']:
+                args = ['--ignore-lint', *args]
+
+            completed = lain_in_process(ctx.find_root().command, args, **kwargs)
 
-    completed = subprocess_run(cmd, **kwargs)
     if exit:
         context().exit(rc(completed))
 
     return completed
 
 
+def lain_in_process(root, args, check=True):
+    """invoke the lain command group directly, saving the cost of a new
+    interpreter, and report the outcome like subprocess_run would"""
+    args = list(args)
+    cmd = ['lain', *args]
+    excall(cmd)
+    try:
+        with root.make_context('lain', args, obj={}) as sub_ctx:
+            root.invoke(sub_ctx)
+
+        code = 0
+    except click.exceptions.Exit as e:
+        code = e.exit_code
+    except click.ClickException as e:
+        e.show()
+        code = e.exit_code
+    except click.exceptions.Abort:
+        code = 1
+    except Exception:
+        # a crashing child process prints its traceback and exits with 1,
+        # behave the same
+        traceback.print_exc()
+        code = 1
+
+    if code and check:
+        context().exit(code)
+
+    return subprocess.CompletedProcess(cmd, code, stdout=b'', stderr=b'')
+
+
 def lain_image(stage='release'):
     if stage == 'prepare':
         return make_image_str(image_tag='prepare')
@@ -1067,8 +1412,13 @@ def subprocess_run(*args, silent=None, dry_run=False, **kwargs):
     excall(*args, silent=silent)
     if dry_run:
         return
+    cmd = args[0]
+    if not isinstance(cmd, str):
+        cmd = subprocess.list2cmdline(cmd)
+
     try:
-        res = subprocess.run(*args, **kwargs)
+        with profile_phase('subprocess', cmd):
+            res = subprocess.run(*args, **kwargs)
     except subprocess.TimeoutExpired:
         timeout = kwargs['timeout']
         stderr = (
@@ -1098,13 +1448,49 @@ def subprocess_run(*args, silent=None, dry_run=False, **kwargs):
     return res
 
 
+def tell_binary_key(name):
+    """identify a binary by its resolved path, mtime and size, so that
+    replacing it invalidates everything we know about it"""
+    path = shutil.which(name)
+    if not path:
+        return
+    path = os.path.realpath(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    return f'{path}:{st.st_mtime_ns}:{st.st_size}'
+
+
+def tell_tool_version(name, args=('--version',), check=False):
+    """run `name *args` and return the last word of its output, result is
+    cached on disk until the binary changes"""
+    key = tell_binary_key(name)
+    cache = load_cache(TOOL_VERSION_CACHE)
+    entry = cache.get(name)
+    if key and entry and entry['key'] == key:
+        return entry['version']
+    version_res = subprocess_run(
+        [name, *args], capture_output=True, check=check, silent=True
+    )
+    version_str = ensure_str(version_res.stdout).strip().split()[-1]
+    if key:
+        cache[name] = {'key': key, 'version': version_str}
+        dump_cache(TOOL_VERSION_CACHE, cache)
+
+    return version_str
+
+
+def forget_tool_version(name):
+    cache = load_cache(TOOL_VERSION_CACHE)
+    if cache.pop(name, None):
+        dump_cache(TOOL_VERSION_CACHE, cache)
+
+
 @lru_cache(maxsize=None)
 def stern_version_challenge():
     try:
-        version_res = subprocess_run(
-            ['stern', '--version'], capture_output=True, check=True, silent=True
-        )
-        version_str = version_res.stdout.decode('utf-8').split()[-1]
+        version_str = tell_tool_version('stern', check=True)
     except FileNotFoundError:
         download_stern()
         return stern_version_challenge()
@@ -1134,10 +1520,7 @@ def stern(*args, check=True, **kwargs):
 @lru_cache(maxsize=None)
 def helm_version_challenge():
     try:
-        version_res = subprocess_run(
-            ['helm', 'version', '--short'], capture_output=True, check=True, silent=True
-        )
-        version_str = version_res.stdout.decode('utf-8')
+        version_str = tell_tool_version('helm', ['version', '--short'], check=True)
     except FileNotFoundError:
         download_helm()
         return helm_version_challenge()
@@ -1159,6 +1542,9 @@ def download_helm():
 
 def helm(*args, check=True, exit=False, **kwargs):
     helm_version_challenge()
+    if args and args[0] in HELM_WRITE_VERBS:
+        RESOURCE_SNAPSHOTS.clear()
+
     cmd = ['helm', *args]
     completed = subprocess_run(cmd, env=ENV, check=check, **kwargs)
     if exit:
@@ -1234,6 +1620,8 @@ def parse_image_tag(image):
 def banyun(image, registry=None, overwrite_latest_tag=False, pull=False, exit=None):
     """搬运镜像到别人家里"""
     if registry and not isinstance(registry, str):
+        import asyncio
+
         loop = asyncio.new_event_loop()
         tasks = []
         for r in registry:
@@ -1300,22 +1688,61 @@ def git(*args, exit=None, check=True, **kwargs):
     return completed
 
 
+def tell_node_label_changes(node_labels, wanted):
+    """minimal label changes, nodes that share the same changes are grouped
+    together so that they can be labeled in one kubectl call
+
+    >>> node_labels = {
+    ...     'node-1': {'dummy-web': 'true'},
+    ...     'node-2': {},
+    ...     'node-3': {'dummy-web': 'true'},
+    ...     'node-4': {},
+    ... }
+    >>> wanted = {'dummy-web': {'node-1', 'node-2', 'node-4'}}
+    >>> tell_node_label_changes(node_labels, wanted)
+    {('dummy-web=true',): ['node-2', 'node-4'], ('dummy-web-',): ['node-3']}
+    >>> tell_node_label_changes({'node-1': {'dummy-web': 'true'}}, {'dummy-web': {'node-1'}})
+    {}
+    """
+    changes = {}
+    for node in sorted(set(node_labels).union(*wanted.values())):
+        labels = node_labels.get(node) or {}
+        ops = []
+        for label_name, nodes in sorted(wanted.items()):
+            if node in nodes:
+                if labels.get(label_name) != 'true':
+                    ops.append(f'{label_name}=true')
+            elif label_name in labels:
+                ops.append(f'{label_name}-')
+
+        if ops:
+            changes.setdefault(tuple(ops), []).append(node)
+
+    return changes
+
+
 def try_to_label_nodes():
     ctx = context()
     appname = ctx.obj['appname']
     deploys = ctx.obj['values']['deployments']
-    for deploy_name, deploy in deploys.items():
-        nodes = deploy.get('nodes')
-        if not nodes:
-            continue
-        label_name = f'{appname}-{deploy_name}'
-        kubectl('label', 'node', '--all', f'{label_name}-', '--overwrite')
-        for node in nodes:
-            kubectl('label', 'node', f'{node}', f'{label_name}=true', '--overwrite')
+    wanted = {
+        f'{appname}-{deploy_name}': set(deploy['nodes'])
+        for deploy_name, deploy in deploys.items()
+        if deploy.get('nodes')
+    }
+    if not wanted:
+        return
+    res = kubectl_get('node', check=True)
+    node_labels = {
+        item['metadata']['name']: item['metadata'].get('labels')
+        for item in jalo(res.stdout)['items']
+    }
+    for ops, nodes in tell_node_label_changes(node_labels, wanted).items():
+        kubectl('label', 'node', *nodes, *ops, '--overwrite')
 
 
 def tell_job_names(appname_prefix=True):
-    values = load_helm_values()
+    values = context().obj['values']
     appname = values['appname']
     job_names = []
     for proc_name in values.get('jobs') or {}:
@@ -1338,24 +1765,27 @@ def try_to_cleanup_job(job_name=None):
     else:
         job_names = tell_job_names()
 
-    for jn in job_names:
-        res = kubectl('delete', 'job', jn, capture_output=True, check=False)
-        if rc(res):
-            stderr = ensure_str(res.stderr)
-            if 'not found' not in stderr:
-                error(f'weird error when deleting job {jn}:')
-                error(stderr, exit=1)
+    if not job_names:
+        return
+    res = kubectl(
+        'delete',
+        'job',
+        *job_names,
+        '--ignore-not-found',
+        capture_output=True,
+        check=False,
+    )
+    if rc(res):
+        error(f'weird error when deleting jobs {job_names}:')
+        error(ensure_str(res.stderr), exit=1)
 
 
 @lru_cache(maxsize=None)
 def kubectl_version_challenge():
     try:
-        version_res = subprocess_run(
-            ['kubectl', 'version', '--short', '--client=true'],
-            capture_output=True,
-            silent=True,
+        version_str = tell_tool_version(
+            'kubectl', ['version', '--short', '--client=true']
         )
-        version_str = version_res.stdout.decode('utf-8').strip().split()[-1]
     except FileNotFoundError:
         download_kubectl()
         return kubectl_version_challenge()
@@ -1377,6 +1807,9 @@ def download_kubectl():
 
 def kubectl(*args, exit=None, check=True, dry_run=False, **kwargs):
     kubectl_version_challenge()
+    if args and args[0] not in KUBECTL_READ_VERBS:
+        RESOURCE_SNAPSHOTS.clear()
+
     cmd = ['kubectl', *args]
     kwargs.setdefault('timeout', 10)
     completed = subprocess_run(cmd, env=ENV, check=check, dry_run=dry_run, **kwargs)
@@ -1386,6 +1819,131 @@ def kubectl(*args, exit=None, check=True, dry_run=False, **kwargs):
     return completed
 
 
+def kubectl_get(kind, name=None, selector=None, field_selector=None, check=False):
+    """kubectl get -ojson, but served by the API server directly if
+    possible, which saves forking kubectl and reuses connections. see
+    lain_cli.kubernetes"""
+    from lain_cli.kubernetes import tell_kubernetes_client
+
+    client = tell_kubernetes_client()
+    res = client and client.get_resource(
+        kind, name=name, selector=selector, field_selector=field_selector
+    )
+    if not res:
+        cmd = ['get', kind, '-ojson']
+        if name:
+            cmd.append(name)
+
+        if selector:
+            cmd.extend(['-l', selector])
+
+        if field_selector:
+            cmd.append(f'--field-selector={field_selector}')
+
+        return kubectl(*cmd, capture_output=True, check=check)
+    code = rc(res)
+    if code and check:
+        error(res.stderr, exit=code)
+
+    return res
+
+
+# a single lain job / lain x looks up the same pods, deployments and jobs
+# several times, so they're kept for a few seconds, keyed by (appname, kind),
+# see resource_snapshot. anything that changes the cluster clears these
+RESOURCE_SNAPSHOTS = {}
+RESOURCE_SNAPSHOT_TTL = 3
+RESOURCE_SNAPSHOT_KINDS = {'Pod': 'pod', 'Deployment': 'deployment', 'Job': 'job'}
+KUBECTL_READ_VERBS = frozenset(
+    ('get', 'describe', 'logs', 'top', 'exec', 'cp', 'version', 'explain')
+)
+HELM_WRITE_VERBS = frozenset(
+    ('install', 'upgrade', 'delete', 'uninstall', 'rollback', 'test')
+)
+
+
+def match_selector(labels, selector):
+    """in memory version of kubectl -l, only equality selectors are supported
+
+    >>> labels = {'app.kubernetes.io/name': 'dummy', 'job-name': 'dummy-x'}
+    >>> match_selector(labels, 'app.kubernetes.io/name=dummy,job-name=dummy-x')
+    True
+    >>> match_selector(labels, 'app.kubernetes.io/name==dummy,foo=bar')
+    False
+    >>> match_selector(labels, None)
+    True
+    """
+    if not selector:
+        return True
+    labels = labels or {}
+    for requirement in selector.split(','):
+        key, value = requirement.replace('==', '=').split('=', 1)
+        if labels.get(key.strip()) != value.strip():
+            return False
+
+    return True
+
+
+def resource_snapshot(appname=None, kinds=None, fresh=False):
+    """list resources of appname (of the whole namespace if appname is None),
+    pods, deployments and jobs unless kinds is given, and keep them for
+    RESOURCE_SNAPSHOT_TTL seconds, fresh=True ignores what's kept, for long
+    running callers like lain status. returns (res, {kind: [item]}), snapshot
+    is None if the listing failed, in which case res tells why"""
+    from lain_cli.kubernetes import tell_kubernetes_client
+
+    kinds = tuple(kinds or RESOURCE_SNAPSHOT_KINDS.values())
+    snapshots = {}
+    for kind in kinds:
+        snapshot = None if fresh else RESOURCE_SNAPSHOTS.get((appname, kind))
+        if snapshot and time() - snapshot['listed_at'] < RESOURCE_SNAPSHOT_TTL:
+            snapshots[kind] = snapshot
+
+    # only list what's not in the snapshots already
+    missing = [kind for kind in kinds if kind not in snapshots]
+    if missing:
+        selector = f'app.kubernetes.io/name={appname}' if appname else None
+        items = {kind: [] for kind in missing}
+        client = tell_kubernetes_client()
+        responses = []
+        if client:
+            responses = [
+                client.get_resource(kind, selector=selector) for kind in missing
+            ]
+
+        if responses and all(responses):
+            for kind, res in zip(missing, responses):
+                if rc(res):
+                    return res, None
+                items[kind] = jalo(res.stdout)['items']
+        else:
+            # kubectl lists several kinds in a single call
+            res = kubectl_get(','.join(missing), selector=selector)
+            if not res.stdout or rc(res):
+                return res, None
+            for item in jalo(res.stdout)['items']:
+                kind = RESOURCE_SNAPSHOT_KINDS.get(item.get('kind'))
+                if kind in items:
+                    items[kind].append(item)
+
+        listed_at = time()
+        for kind in missing:
+            snapshot = {'res': res, 'items': items[kind], 'listed_at': listed_at}
+            RESOURCE_SNAPSHOTS[(appname, kind)] = snapshots[kind] = snapshot
+
+    res = snapshots[kinds[0]]['res']
+    return res, {kind: snapshot['items'] for kind, snapshot in snapshots.items()}
+
+
+def find_snapshot_item(kind, name, appname=None):
+    _, snapshot = resource_snapshot(appname, kinds=[kind])
+    for item in (snapshot or {}).get(kind, []):
+        if item['metadata']['name'] == name:
+            return item
+
+    return None
+
+
 def get_pod_rc(pod_name, tries=5):
     while tries:
         tries -= 1
@@ -1413,89 +1971,280 @@ def is_inside_cluster():
 
 
 def wait_for_svc_up(tries=20):
+    """probe all service urls concurrently until they respond, gives up
+    after tries * 3 seconds. returns {'up': bool, 'durations': {url: seconds
+    it took to come up}, 'late': {url: last error}}"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from requests.adapters import HTTPAdapter
+    from requests.exceptions import RequestException
+
     release_name = tell_release_name()
     selector = f'helm.sh/chart={release_name}'
-    res = kubectl(
-        'get',
-        'svc',
-        '-l',
-        selector,
-        '--no-headers=true',
-        capture_output=True,
-        check=False,
-    )
+    res = kubectl_get('svc', selector=selector)
+    svclist = jalo(res.stdout) if res.stdout and not rc(res) else {}
     svc_urls = []
-    for line in ensure_str(res.stdout).splitlines():
-        svc_name, _, _, _, port, _ = line.split()
-        portnum = int(port.split('/', 1)[0])
-        svc_urls.append(f'http://{svc_name}:{portnum}')
-
-    def test_urls(urls):
-        for url in svc_urls:
-            try:
-                requests.get(url, timeout=1)
-            except Exception as e:
-                warn(f'{url} not up due to {e}')
-                return False
+    for svc in svclist.get('items', []):
+        ports = svc['spec'].get('ports')
+        if ports:
+            svc_urls.append(f'http://{svc["metadata"]["name"]}:{ports[0]["port"]}')
+
+    started_at = time()
+    deadline = started_at + tries * 3
+    durations = {}
+    late = dict.fromkeys(svc_urls, 'never probed')
+    if not svc_urls:
+        return {'up': True, 'durations': durations, 'late': late}
+    session = traced_session()
+    adapter = HTTPAdapter(pool_maxsize=len(svc_urls))
+    session.mount('http://', adapter)
+
+    def test_url(url):
+        try:
+            session.get(url, timeout=1)
+        except RequestException as e:
+            return e
+        return None
+
+    backoff = 0.5
+    with session, ThreadPoolExecutor(max_workers=len(svc_urls)) as executor:
+        while late:
+            urls = list(late)
+            for url, e in zip(urls, executor.map(test_url, urls)):
+                if e:
+                    debug(f'{url} not up due to {e}')
+                    late[url] = e
+                else:
+                    durations[url] = time() - started_at
+                    del late[url]
+
+            if not late or time() >= deadline:
+                break
+            sleep(max(min(backoff, deadline - time()), 0))
+            backoff = min(backoff * 2, 3)
+
+    for url, e in late.items():
+        warn(f'{url} not up due to {e}')
+
+    return {'up': not late, 'durations': durations, 'late': late}
+
+
+def tell_pod_status(pod):
+    """the STATUS column of kubectl get pod, computed from pod json
+
+    >>> running = {'ready': True, 'state': {'running': {}}}
+    >>> tell_pod_status({'status': {'phase': 'Running', 'containerStatuses': [running]}})
+    'Running'
+    >>> creating = {'ready': False, 'state': {'waiting': {'reason': 'ContainerCreating'}}}
+    >>> tell_pod_status({'status': {'phase': 'Pending', 'containerStatuses': [creating]}})
+    'ContainerCreating'
+    >>> init = {'state': {'waiting': {'reason': 'PodInitializing'}}}
+    >>> pod = {'spec': {'initContainers': [{}]}, 'status': {'phase': 'Pending', 'initContainerStatuses': [init]}}
+    >>> tell_pod_status(pod)
+    'Init:0/1'
+    >>> tell_pod_status({'metadata': {'deletionTimestamp': 'x'}, 'status': {'phase': 'Running'}})
+    'Terminating'
+    """
+    status = pod.get('status') or {}
+    reason = status.get('reason') or status.get('phase') or 'Unknown'
+    init_containers = (pod.get('spec') or {}).get('initContainers') or []
+    initializing = False
+    for i, container in enumerate(status.get('initContainerStatuses') or []):
+        state = container.get('state') or {}
+        terminated = state.get('terminated')
+        waiting = state.get('waiting')
+        if terminated and terminated.get('exitCode') == 0:
+            continue
+        initializing = True
+        if terminated:
+            reason = 'Init:' + (
+                terminated.get('reason') or f'ExitCode:{terminated.get("exitCode")}'
+            )
+        elif waiting and waiting.get('reason', 'PodInitializing') != 'PodInitializing':
+            reason = f'Init:{waiting["reason"]}'
+        else:
+            reason = f'Init:{i}/{len(init_containers)}'
+        break
+
+    if not initializing:
+        has_running = False
+        for container in reversed(status.get('containerStatuses') or []):
+            state = container.get('state') or {}
+            terminated = state.get('terminated') or {}
+            waiting_reason = (state.get('waiting') or {}).get('reason')
+            if waiting_reason:
+                reason = waiting_reason
+            elif terminated.get('reason'):
+                reason = terminated['reason']
+            elif terminated:
+                reason = f'ExitCode:{terminated.get("exitCode")}'
+            elif container.get('ready') and 'running' in state:
+                has_running = True
+
+        if reason == 'Completed' and has_running:
+            reason = 'Running'
+
+    if (pod.get('metadata') or {}).get('deletionTimestamp'):
+        reason = 'Unknown' if status.get('reason') == 'NodeLost' else 'Terminating'
+
+    return reason
+
+
+def tell_pod_ready(pod):
+    """(ready containers, all containers), the READY column of kubectl get pod"""
+    statuses = (pod.get('status') or {}).get('containerStatuses') or []
+    containers = (pod.get('spec') or {}).get('containers') or statuses
+    return sum(bool(s.get('ready')) for s in statuses), len(containers)
+
+
+POD_WAITING_STATES = frozenset(
+    ('pending', 'containercreating', 'notready', 'terminating')
+)
 
-        return True
 
-    while tries:
-        tries -= 1
-        sleep(3)
-        if test_urls(svc_urls):
-            return True
+def is_pod_waiting(pod):
+    state = tell_pod_status(pod).lower()
+    if state == 'running':
+        n_ready, n_all = tell_pod_ready(pod)
+        if n_ready != n_all:
+            state = 'notready'
 
-    return False
+    return state in POD_WAITING_STATES
 
 
 def wait_for_pod_up(selector=None, tries=40):
+    """wait until no pods matching selector are pending / not ready, gives up
+    after tries * 3 seconds. when the API server is reachable, pod changes are
+    followed with the watch API, otherwise pods are listed every 3 seconds"""
+    from lain_cli.kubernetes import tell_kubernetes_client
+
     if not selector:
         ctx = context()
         appname = ctx.obj['appname']
         selector = f'app.kubernetes.io/name={appname}'
 
-    waiting_state = frozenset(
-        ('pending', 'containercreating', 'notready', 'terminating')
+    client = tell_kubernetes_client()
+    started_at = time()
+    deadline = started_at + tries * 3
+    # pods might not be created yet, give them a moment before accepting an
+    # empty result
+    grace_deadline = started_at + 3
+    pods = {}
+
+    def pods_up():
+        for pod_name, pod in pods.items():
+            debug(f'{pod_name} {tell_pod_status(pod)}')
+
+        if not pods and time() < grace_deadline:
+            return False
+        return not any(is_pod_waiting(pod) for pod in pods.values())
+
+    while True:
+        res = kubectl_get('pod', selector=selector)
+        podlist = jalo(res.stdout) if res.stdout and not rc(res) else {}
+        pods = {item['metadata']['name']: item for item in podlist.get('items', [])}
+        if pods_up():
+            return sorted(pods)
+        now = time()
+        if now >= deadline:
+            break
+        resource_version = (podlist.get('metadata') or {}).get('resourceVersion')
+        # an empty pod list is only re-checked after the grace period
+        until = grace_deadline if not pods else deadline
+        if client and resource_version:
+            events = client.watch_resource(
+                'pod', resource_version, selector=selector, timeout=until - now
+            )
+            for event_type, pod in events:
+                if event_type not in {'ADDED', 'MODIFIED', 'DELETED'}:
+                    continue
+                pod_name = pod['metadata']['name']
+                if event_type == 'DELETED':
+                    pods.pop(pod_name, None)
+                else:
+                    pods[pod_name] = pod
+
+                if pods_up():
+                    return sorted(pods)
+
+        # watch ended or was interrupted, list again shortly
+        sleep(max(min(3, until - time()), 0))
+
+    waiting_pods = [name for name, pod in pods.items() if is_pod_waiting(pod)]
+    pod_name = waiting_pods[0] if waiting_pods else f'-l {selector}'
+    error('job container never got up, use these commands to see what\'s wrong:')
+    error(f'k describe po {pod_name}')
+    error(f'k logs {pod_name}')
+
+
+def restart_deployment(deploy_name):
+    """what kubectl rollout restart does: bump an annotation in pod template,
+    so that pods are replaced according to the rolling update strategy"""
+    restarted_at = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    annotations = {'kubectl.kubernetes.io/restartedAt': restarted_at}
+    patch = {'spec': {'template': {'metadata': {'annotations': annotations}}}}
+    return kubectl(
+        'patch',
+        'deployment',
+        deploy_name,
+        '-p',
+        jadu(patch),
+        capture_output=True,
+        check=False,
     )
-    while tries:
-        tries -= 1
-        sleep(3)
+
+
+def follow_rollouts(deploy_names, timeout=600, before=None, started_at=None):
+    """follow the rollouts of several deployments at the same time, before
+    (if provided) is called with the deployment name right before following
+    it, e.g. to trigger the rollout. returns {deploy_name: (seconds it took
+    since started_at or before, error message or None)}"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def follow(deploy_name):
+        since = started_at or time()
+        if before:
+            res = before(deploy_name)
+            if rc(res):
+                return time() - since, ensure_str(res.stderr)
         res = kubectl(
-            'get',
-            'po',
-            '-l',
-            selector,
-            '--no-headers=true',
+            'rollout',
+            'status',
+            f'deployment/{deploy_name}',
+            f'--timeout={timeout}s',
             capture_output=True,
             check=False,
+            timeout=None,
         )
-        stdout = ensure_str(res.stdout)
-        pod_lines = stdout.splitlines()
-        current_states = set()
-        pod_names = []
-        for line in pod_lines:
-            debug(line)
-            pod_name, ready_pair, state, *_ = line.split()
-            state = state.lower()
-            if state == 'running':
-                n_ready, n_all = ready_pair.split('/')
-                if n_ready != n_all:
-                    state = 'notready'
-
-            current_states.add(state.lower())
-            pod_names.append(pod_name)
-
-        if not current_states.intersection(waiting_state):
-            return pod_names
-        debug(stdout)
-        continue
-    error('job container never got up, use these commands to see what\'s wrong:')
-    error(f'k describe po {pod_name}')
-    error(f'k logs {pod_name}')
+        return time() - since, ensure_str(res.stderr) if rc(res) else None
+
+    if not deploy_names:
+        return {}
+    # may download kubectl, which must not happen in several threads at once
+    kubectl_version_challenge()
+    with ThreadPoolExecutor(max_workers=len(deploy_names)) as executor:
+        # so that kubectl respects silent / verbose in worker threads
+        results = executor.map(with_context(follow), deploy_names)
+        return dict(zip(deploy_names, results))
+
+
+def report_rollouts(results):
+    """print what follow_rollouts returns, tells if any rollout failed"""
+    failed = False
+    for deploy_name, (duration, stderr) in results.items():
+        if stderr:
+            failed = True
+            error(f'{deploy_name} failed after {duration:.1f}s: {stderr}')
+        else:
+            echo(f'{deploy_name} ready after {duration:.1f}s')
+
+    return failed
 
 
 def wait_for_cluster_up(tries=1):
+    import requests
+    from requests.exceptions import RequestException
+
     context().obj['silent'] = True
     cluster_info = tell_cluster_info()
     url = f'http://default-backend.{cluster_info["domain"]}'
@@ -1574,6 +2323,8 @@ def download_binary(url, dest, extract=None):
     else:
         download_path = dest
 
+    import requests
+
     try:
         with requests.get(url, stream=True) as res:
             with open(download_path, 'wb') as f:
@@ -1595,6 +2346,7 @@ def download_binary(url, dest, extract=None):
     # do a `chmod +x` on this thing
     st = os.stat(dest)
     os.chmod(dest, st.st_mode | stat.S_IEXEC)
+    forget_tool_version(basename(dest))
 
 
 def ensure_absent(path):
@@ -1644,13 +2396,33 @@ def yalo(f, many=False):
         with open(f.name) as file_again:
             f = file_again.read()
 
-    load = yaml.safe_load_all if many else yaml.safe_load
+    yml = fast_yaml()
+    load = yml.load_all if many else yml.load
     return load(f)
 
 
-def yadu(dic, f=None):
-    yaml.scalarstring.walk_tree(dic)
-    s = yaml.round_trip_dump(dic, allow_unicode=True)
+def fast_yaml():
+    """ruamel.yaml uses the LibYAML parser and emitter for typ='safe' if
+    ruamel.yaml.clib is installed, and falls back to pure python if not.
+    YAML instances aren't thread safe, so make a new one every time"""
+    yml = yaml.YAML(typ='safe')
+    yml.default_flow_style = False
+    yml.allow_unicode = True
+    yml.representer.sort_base_mapping_type_on_output = False
+    return yml
+
+
+def yadu(dic, f=None, fast=False):
+    """dump dic as yaml. the default round trip mode prints multiline
+    strings as literal blocks, use it for anything a human will read or
+    edit. fast=True is for machine consumption, like kubectl apply"""
+    if fast:
+        buf = StringIO()
+        fast_yaml().dump(dic, buf)
+        s = buf.getvalue()
+    else:
+        yaml.scalarstring.walk_tree(dic)
+        s = yaml.round_trip_dump(dic, allow_unicode=True)
     if not f:
         return s
     if hasattr(f, 'read'):
@@ -1674,6 +2446,46 @@ def jalo(s):
         raise ValueError('cannot decode this shit: {}'.format(ensure_str(s))) from e
 
 
+def load_cache(name):
+    """cache files live under LAIN_CACHE_DIR, a broken or missing cache is
+    simply treated as empty"""
+    with suppress(OSError, ValueError):
+        with open(join(LAIN_CACHE_DIR, name)) as f:
+            return jalo(f.read())
+
+    return {}
+
+
+def dump_cache(name, dic):
+    # sets are dumped as sorted lists, anything else that json doesn't
+    # understand raises TypeError
+    s = json.dumps(dic, separators=(',', ':'), default=sorted)
+    path = join(LAIN_CACHE_DIR, name)
+    try:
+        os.makedirs(dirname(path), exist_ok=True)
+        # write to a tempfile and then rename, so that concurrent lain
+        # processes never read a half written cache
+        f = NamedTemporaryFile('w', dir=dirname(path), delete=False)
+        with f:
+            f.write(s)
+
+        os.replace(f.name, path)
+    except OSError as e:
+        debug(f'cannot write cache {name}: {e}')
+
+
+def prune_cache(dirname_, keep):
+    """only keep the most recent files under LAIN_CACHE_DIR/dirname_"""
+    d = join(LAIN_CACHE_DIR, dirname_)
+    with suppress(OSError):
+        paths = sorted(
+            (join(d, fname) for fname in os.listdir(d)),
+            key=os.path.getmtime,
+            reverse=True,
+        )
+        ensure_absent(paths[keep:])
+
+
 def brief(s):
     r"""
     >>> a = 'a' * 89
@@ -1896,25 +2708,104 @@ def validate_proc_name(ctx, param, value):
     return value
 
 
-def load_helm_values(values_yaml=f'./{CHART_DIR_NAME}/values.yaml'):
-    if hasattr(values_yaml, 'read'):
-        values = yalo(values_yaml)
+def read_bytes(f):
+    if hasattr(f, 'read'):
+        f.seek(0)
+        content = f.read()
+        f.seek(0)
     else:
-        with open(values_yaml) as f:
-            values = yalo(f)
+        with open(f, 'rb') as file_:
+            content = file_.read()
+
+    if isinstance(content, str):
+        return content.encode('utf-8')
+    return content
+
+
+def tell_linked_values_file(cluster_values_file):
+    """cluster values file may just be a plain text "link" to another values
+    file, see load_helm_values"""
+    content = ensure_str(read_bytes(cluster_values_file)).strip()
+    if '\n' in content:
+        return
+    linked_file = join(CHART_DIR_NAME, content)
+    if isfile(linked_file):
+        return linked_file
+
+
+def helm_values_cache_key(contents):
+    """values are decided by the content of all values files, lain itself, and
+    CLUSTERS (see HelmValuesSchema.finalize)"""
+    h = blake2b(digest_size=16, key=b'lain')
+    h.update(__version__.encode('utf-8'))
+    for name, cluster_info in CLUSTERS.items():
+        registry = cluster_info.get('registry')
+        offline = cluster_info.get('offline')
+        h.update(f'{name}:{registry}:{offline}'.encode('utf-8'))
+
+    for content in contents:
+        h.update(b'\0')
+        if content:
+            h.update(content)
+
+    return h.hexdigest()
+
+
+def restore_helm_values(values):
+    """json knows nothing about sets or shared references, undo the damage
+    done by caching"""
+    values['publish_to'] = set(values['publish_to'])
+    values['publish_to_registries'] = set(values['publish_to_registries'])
+    values['procs'] = values['deployments'].copy()
+    values['procs'].update(values['cronjobs'])
+    return values
+
 
+def cache_helm_values(cache_name, loaded):
+    try:
+        restored = restore_helm_values(jalo(json.dumps(loaded, default=sorted)))
+    except TypeError:
+        # values contains something json cannot handle, like timestamps
+        return
+    if restored != loaded:
+        return
+    dump_cache(cache_name, loaded)
+    prune_cache(HELM_VALUES_CACHE_DIR, HELM_VALUES_CACHE_SIZE)
+
+
+def load_helm_values(values_yaml=f'./{CHART_DIR_NAME}/values.yaml'):
+    # raises FileNotFoundError if not in a lain app
+    values_content = read_bytes(values_yaml)
     internal_values_file = tell_cluster_values_file(internal=True)
+    cluster_values_file = tell_cluster_values_file()
+    linked_file = cluster_values_file and tell_linked_values_file(cluster_values_file)
+    ctx = context()
+    extra_values_file = ctx.obj['extra_values_file']
+    sources = [
+        internal_values_file,
+        cluster_values_file,
+        linked_file,
+        extra_values_file,
+    ]
+    cache_key = helm_values_cache_key(
+        [values_content, *[f and read_bytes(f) for f in sources]]
+    )
+    cache_name = join(HELM_VALUES_CACHE_DIR, f'{cache_key}.json')
+    cached = load_cache(cache_name)
+    if cached:
+        debug(f'using cached helm values: {cache_name}')
+        return restore_helm_values(cached)
+
+    values = yalo(values_content)
     if internal_values_file:
         recursive_update(values, yalo(open(internal_values_file)))
 
-    cluster_values_file = tell_cluster_values_file()
     if cluster_values_file:
         dic = yalo(open(cluster_values_file))
         if not isinstance(dic, dict):
             # 调用 gitlab 接口对 link 类型的文件处理有问题, 下载下来以后只是一个普通的文本文件
             # 只好在代码里实现一下 link 咯
-            if isinstance(dic, str) and isfile(join(CHART_DIR_NAME, dic)):
-                linked_file = join(CHART_DIR_NAME, dic)
+            if isinstance(dic, str) and linked_file:
                 dic = yalo(open(linked_file))
             else:
                 error(
@@ -1924,8 +2815,6 @@ def load_helm_values(values_yaml=f'./{CHART_DIR_NAME}/values.yaml'):
 
         recursive_update(values, dic)
 
-    ctx = context()
-    extra_values_file = ctx.obj['extra_values_file']
     if extra_values_file:
         recursive_update(values, yalo(extra_values_file))
 
@@ -1936,12 +2825,79 @@ def load_helm_values(values_yaml=f'./{CHART_DIR_NAME}/values.yaml'):
         error('your values.yaml did not pass schema check:')
         error(e, exit=1)
 
+    cache_helm_values(cache_name, loaded)
     return loaded
 
 
+class LazyObj(dict):
+    """ctx.obj that computes expensive keys on first access, and memoize
+    them. a loader returns a dict, so that a group of keys can be computed
+    in one go, keys that are already set are left untouched.
+
+    implicit keys are computed as well when the whole mapping is read (like
+    template.render(**ctx.obj)), because templates expect them to be there
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loaders = {}
+        self.implicit = set()
+        # worker threads may read ctx.obj as well, a loader may read other
+        # lazy keys, hence the RLock
+        self.lock = threading.RLock()
+
+    def lazy(self, keys, loader, implicit=False):
+        for key in keys:
+            self.loaders[key] = loader
+
+        if implicit:
+            self.implicit.update(keys)
+
+    def __missing__(self, key):
+        with self.lock:
+            # another thread may have loaded it while this one was waiting
+            if super().__contains__(key):
+                return super().__getitem__(key)
+            loader = self.loaders.get(key)
+            if not loader:
+                raise KeyError(key)
+            # a failed loader won't be retried, the key simply stays missing
+            for k in [k for k, l in self.loaders.items() if l is loader]:
+                del self.loaders[k]
+
+            for k, v in loader().items():
+                self.setdefault(k, v)
+
+            return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def realize(self):
+        for key in self.implicit.intersection(self.loaders):
+            self.get(key)
+
+    def __iter__(self):
+        self.realize()
+        return super().__iter__()
+
+    def keys(self):
+        self.realize()
+        return super().keys()
+
+    def items(self):
+        self.realize()
+        return super().items()
+
+
+@profile_phase('ensure_helm_initiated')
 def ensure_helm_initiated():
     """gather basic information about the current app.
-    If cluster info is provided, will try to fetch app status from Kubernetes"""
+    values and everything derived from it are loaded on first access, see
+    LazyObj"""
     with suppress(FileNotFoundError, OSError):
         tell_cluster()
 
@@ -1950,24 +2906,36 @@ def ensure_helm_initiated():
         warn(f'you better unset these variables: {lookout_env}')
 
     ctx = context()
+    if not isinstance(ctx.obj, LazyObj):
+        ctx.obj = LazyObj(ctx.obj)
+
     obj = ctx.obj
     obj['chart_name'] = CHART_DIR_NAME
     obj['chart_version'] = CHART_VERSION
+    obj.lazy(['cluster_info'], lambda: {'cluster_info': tell_cluster_info()})
+    obj.lazy(['lain_meta'], lambda: {'lain_meta': lain_meta()})
     values_yaml = f'./{CHART_DIR_NAME}/values.yaml'
-    try:
-        values = load_helm_values(values_yaml)
-        appname = obj['appname'] = values['appname']
-        obj['values'] = values
-        obj['secret_name'] = f'{appname}-secret'
-        obj['env_name'] = f'{appname}-env'
-    except FileNotFoundError:
+    if not isfile(values_yaml):
         warn('not in a lain4 app repo')
-        raise
-    except KeyError:
-        error(
-            f'{values_yaml} doesn\'t look like a valid lain4 yaml, if you want to use lain4 for this app, use `lain inif -f`'
-        )
-        raise
+        raise FileNotFoundError(values_yaml)
+
+    def load_app_values():
+        try:
+            values = load_helm_values(values_yaml)
+            appname = values['appname']
+        except KeyError:
+            error(
+                f'{values_yaml} doesn\'t look like a valid lain4 yaml, if you want to use lain4 for this app, use `lain inif -f`'
+            )
+            raise
+        return {
+            'values': values,
+            'appname': appname,
+            'secret_name': f'{appname}-secret',
+            'env_name': f'{appname}-env',
+        }
+
+    obj.lazy(['values', 'appname', 'secret_name', 'env_name'], load_app_values, True)
     # collect all uppercase consts
     for k, v in globals().items():
         if k.isupper() and not k.startswith('_'):
@@ -1975,7 +2943,7 @@ def ensure_helm_initiated():
                 continue
             obj[k] = v
 
-    obj['urls'] = tell_ingress_urls()
+    obj.lazy(['urls'], lambda: {'urls': tell_ingress_urls()}, True)
 
 
 def get_app_status(appname):
@@ -2004,10 +2972,16 @@ class literal(str):
 
 
 def literal_presenter(dumper, data):
-    return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='|')
+    # the LibYAML emitter won't take str subclasses
+    return dumper.represent_scalar('tag:yaml.org,2002:str', str(data), style='|')
 
 
 yaml.add_representer(literal, literal_presenter)
+yaml.SafeRepresenter.add_representer(literal, literal_presenter)
+# yadu(dic) leaves LiteralScalarString in dic
+yaml.SafeRepresenter.add_representer(
+    yaml.scalarstring.LiteralScalarString, literal_presenter
+)
 
 
 class KVPairType(click.ParamType):
@@ -2015,7 +2989,7 @@ class KVPairType(click.ParamType):
 
     def convert(self, value, param, ctx):
         try:
-            k, v = value.split('=')
+            k, v = value.split('=', 1)
             return (k, v)
         except (AttributeError, ValueError):
             self.fail(
@@ -2026,6 +3000,43 @@ class KVPairType(click.ParamType):
             )
 
 
+def index_metadata(items):
+    """inverted index from (field, key, value) to positions in items, field
+    being annotations or labels
+
+    >>> items = [{'metadata': {'labels': {'app': 'dummy'}, 'annotations': {'foo': 'a b'}}}]
+    >>> index_metadata(items)[('annotations', 'foo', 'a b')]
+    {0}
+    """
+    index = {}
+    for i, item in enumerate(items):
+        metadata = item['metadata']
+        for field in ('annotations', 'labels'):
+            for k, v in (metadata.get(field) or {}).items():
+                index.setdefault((field, k, v), set()).add(i)
+
+    return index
+
+
+def query_metadata_index(index, predicates, match_all=True):
+    """positions of items that satisfy all (or any) of the predicates, which
+    are (field, key, value) tuples
+
+    >>> index = {('labels', 'app', 'dummy'): {0, 1}, ('annotations', 'foo', 'bar'): {1, 2}}
+    >>> predicates = [('labels', 'app', 'dummy'), ('annotations', 'foo', 'bar')]
+    >>> sorted(query_metadata_index(index, predicates))
+    [1]
+    >>> sorted(query_metadata_index(index, predicates, match_all=False))
+    [0, 1, 2]
+    """
+    matches = [index.get(predicate, set()) for predicate in predicates]
+    if not matches:
+        return set()
+    if match_all:
+        return set.intersection(*matches)
+    return set.union(*matches)
+
+
 def is_values_file(fname):
     """
     >>> is_values_file('foo/bar/values.yaml')
@@ -2313,14 +3324,17 @@ def make_job_name(command):
     return job_name
 
 
-def version_challenge():
-    ctx = context()
-    if ctx.obj['ignore_lint']:
-        return
+def find_latest_lain_version(pypi_index):
+    # pip internals take hundreds of milliseconds to import, only pay for it
+    # when we actually query the index
+    from pip._internal.index.collector import LinkCollector
+    from pip._internal.index.package_finder import PackageFinder
+    from pip._internal.models.search_scope import SearchScope
+    from pip._internal.models.selection_prefs import SelectionPreferences
+    from pip._internal.network.session import PipSession
+
     session = PipSession()
     session.timeout = 2
-    cluster_info = tell_cluster_info()
-    pypi_index = cluster_info['pypi_index']
     search_scope = SearchScope.create(find_links=[], index_urls=[pypi_index])
     link_collector = LinkCollector(session=session, search_scope=search_scope)
     selection_prefs = SelectionPreferences(
@@ -2334,10 +3348,73 @@ def version_challenge():
     best_candidate = finder.find_best_candidate('lain_cli').best_candidate
     debug(f'best candidate: {best_candidate}')
     if not best_candidate:
+        return
+    return str(best_candidate.version)
+
+
+def refresh_latest_lain_version(pypi_index):
+    """query pypi_index and write the result to the version challenge cache.
+    failed lookups aren't cached, or a single network hiccup would turn off
+    the version challenge for the whole ttl"""
+    latest = find_latest_lain_version(pypi_index)
+    if not latest:
+        return latest
+    cache = load_cache(VERSION_CHALLENGE_CACHE)
+    cache[pypi_index] = {'version': latest, 'checked_at': time()}
+    dump_cache(VERSION_CHALLENGE_CACHE, cache)
+    return latest
+
+
+def spawn_version_refresh(pypi_index):
+    """refresh version challenge cache in a detached process, so that the
+    current command doesn't have to wait for pypi"""
+    cache = load_cache(VERSION_CHALLENGE_CACHE)
+    entry = cache.get(pypi_index) or {}
+    # another lain process is already on it
+    if time() - entry.get('refreshing_at', 0) < 60:
+        return
+    entry['refreshing_at'] = time()
+    cache[pypi_index] = entry
+    dump_cache(VERSION_CHALLENGE_CACHE, cache)
+    code = f'from lain_cli.utils import refresh_latest_lain_version; refresh_latest_lain_version({pypi_index!r})'
+    subprocess.Popen(
+        [sys.executable, '-c', code],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def tell_latest_lain_version(pypi_index, ttl=None):
+    """latest lain_cli version on pypi_index, served from cache when possible.
+    stale cache is still used, but a background refresh is kicked off"""
+    if ttl is None:
+        ttl = VERSION_CHALLENGE_TTL
+
+    entry = load_cache(VERSION_CHALLENGE_CACHE).get(pypi_index)
+    if not ttl or not entry or 'checked_at' not in entry:
+        return refresh_latest_lain_version(pypi_index)
+    if time() - entry['checked_at'] > ttl:
+        debug('version challenge cache expired, refreshing in background')
+        spawn_version_refresh(pypi_index)
+
+    return entry['version']
+
+
+@profile_phase('version_challenge')
+def version_challenge():
+    ctx = context()
+    if ctx.obj['ignore_lint']:
+        return
+    cluster_info = tell_cluster_info()
+    pypi_index = cluster_info['pypi_index']
+    latest = tell_latest_lain_version(pypi_index)
+    if not latest:
         warn(f'fail to lookup latest version from {pypi_index}')
         return
     now = version.parse(__version__)
-    new = best_candidate.version
+    new = version.parse(latest)
     if any([now.major > new.major, now.minor > new.minor]):
         return
     if not all(
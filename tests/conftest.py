@@ -1,8 +1,12 @@
+import json
 import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from os import chdir, environ, getcwd
 from os.path import abspath, dirname, join
 from random import choice
 from string import ascii_letters
+from threading import Thread
+from urllib.parse import unquote
 from typing import Any, Tuple
 
 import click
@@ -15,6 +19,8 @@ from lain_cli.utils import (
     CHART_DIR_NAME,
     CLUSTERS,
     DOCKERFILE_NAME,
+    ENV,
+    RESOURCE_SNAPSHOTS,
     change_dir,
     ensure_absent,
     ensure_helm_initiated,
@@ -22,6 +28,7 @@ from lain_cli.utils import (
     kubectl,
     lain_meta,
     rc,
+    yadu,
     yalo,
     make_canary_name,
 )
@@ -125,6 +132,11 @@ def run_under_click_context(
     return res, cache['func_result']
 
 
+@pytest.fixture(autouse=True)
+def forget_resource_snapshots():
+    RESOURCE_SNAPSHOTS.clear()
+
+
 @pytest.fixture()
 def dummy_helm_chart(request):
     def tear_down():
@@ -168,6 +180,74 @@ def registry(request):
     )
 
 
+class FakeKubernetesApi:
+    """stand-in for the kubernetes API server, serves whatever is put in
+    routes: {path: (status, body)}, paths include the unquoted query string,
+    or not, to match any query. str bodies are sent as is"""
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                path = unquote(self.path)
+                api.requests.append((self.command, path, self.client_address))
+                not_found = {'kind': 'Status', 'reason': 'NotFound', 'message': 'nope'}
+                status, body = api.routes.get(
+                    path, api.routes.get(path.split('?')[0], (404, not_found))
+                )
+                if not isinstance(body, str):
+                    body = json.dumps(body)
+                content = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.endpoint = f'http://127.0.0.1:{self.server.server_port}'
+
+    def kubeconfig(self, path):
+        yadu(
+            {
+                'apiVersion': 'v1',
+                'kind': 'Config',
+                'current-context': TEST_CLUSTER,
+                'contexts': [
+                    {
+                        'name': TEST_CLUSTER,
+                        'context': {'cluster': TEST_CLUSTER, 'user': 'lain'},
+                    }
+                ],
+                'clusters': [
+                    {'name': TEST_CLUSTER, 'cluster': {'server': self.endpoint}}
+                ],
+                'users': [{'name': 'lain', 'user': {'token': 'whatever'}}],
+            },
+            path,
+        )
+
+
+@pytest.fixture()
+def kubernetes_api(mocker, tmp_path):
+    api = FakeKubernetesApi()
+    kubeconfig = str(tmp_path / 'kubeconfig')
+    api.kubeconfig(kubeconfig)
+    mocker.patch.dict(ENV, {'KUBECONFIG': kubeconfig})
+    Thread(target=api.server.serve_forever, daemon=True).start()
+    yield api
+    api.server.shutdown()
+    api.server.server_close()
+
+
 def dic_contains(big, small):
     left = big.copy()
     left.update(small)
@@ -1,25 +1,62 @@
+import asyncio
+import base64
+import json
+import os
+import subprocess
+import sys
+import threading
 from os.path import basename, join
 from tempfile import NamedTemporaryFile, TemporaryDirectory
+from time import sleep
+from unittest.mock import call
 
 import click
 import pytest
+from ruamel import yaml
 
 from lain_cli.aliyun import AliyunRegistry
 from lain_cli.harbor import HarborRegistry
+from lain_cli.lain import lain
 from lain_cli.utils import (
     CLUSTERS,
+    ENV,
+    HelmValuesSchema,
     INTERNAL_CLUSTER_VALUES_DIR,
+    PROFILE,
+    PodRecord,
+    VERSION_CHALLENGE_CACHE,
     banyun,
     change_dir,
     context,
+    dump_cache,
     ensure_str,
+    fast_yaml,
+    find_snapshot_item,
+    get_pods,
+    kubectl,
+    kubectl_get,
+    lain_,
     lain_meta,
+    literal,
     load_helm_values,
     make_job_name,
+    pick_pod,
+    print_profile_report,
+    rc,
+    resource_snapshot,
     subprocess_run,
     tell_cluster,
     tell_cluster_values_file,
     tell_helm_options,
+    tell_latest_lain_version,
+    tell_secret,
+    tell_tool_version,
+    template_env,
+    try_to_cleanup_job,
+    try_to_label_nodes,
+    wait_for_pod_up,
+    wait_for_svc_up,
+    with_context,
     yadu,
     yalo,
 )
@@ -27,11 +64,29 @@ from tests.conftest import (
     CHART_DIR_NAME,
     DUMMY_APPNAME,
     DUMMY_REPO,
+    DUMMY_URL,
+    DUMMY_VALUES_PATH,
     TEST_CLUSTER,
     TEST_CLUSTER_INFO,
+    run,
     run_under_click_context,
 )
 
+# these are only needed by a handful of commands, and must be imported lazily
+LAZY_MODULES = (
+    'gitlab',
+    'pip._internal',
+    'prompt_toolkit',
+    'requests',
+    'sentry_sdk',
+    'tencentcloud',
+    'lain_cli.kibana',
+    'lain_cli.kubernetes',
+    'lain_cli.prometheus',
+    'lain_cli.prompt',
+    'lain_cli.registry',
+    'lain_cli.tencent',
+)
 BULLSHIT = '不过我倒不在乎做什么工作,只要没人认识我,我也不认识他们就行了。我还会装作自己是个又聋又哑的人。这样我就可以不必跟任何人讲些他妈的没意思的废话。'
 
 
@@ -41,6 +96,18 @@ def test_make_job_name():
     assert res == 'dummy-5562bd9d33e0c6ce'  # this is a stable hash value
 
 
+def test_lazy_imports():
+    # importing lain_cli.lain used to take ~800ms, mostly because of these
+    code = 'import sys; import lain_cli.lain; print(" ".join(sys.modules))'
+    res = subprocess.run([sys.executable, '-c', code], capture_output=True, check=True)
+    eager = [
+        m
+        for m in ensure_str(res.stdout).split()
+        if any(m == lazy or m.startswith(f'{lazy}.') for lazy in LAZY_MODULES)
+    ]
+    assert not eager
+
+
 def test_ya():
     dic = {'slogan': BULLSHIT}
     f = NamedTemporaryFile()
@@ -49,6 +116,77 @@ def test_ya():
     assert yalo(f) == dic
 
 
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_ya_fast_path():
+    with open(DUMMY_VALUES_PATH) as f:
+        values_yaml = f.read()
+
+    secret = {
+        'apiVersion': 'v1',
+        'kind': 'Secret',
+        'metadata': {'name': f'{DUMMY_APPNAME}-secret', 'namespace': 'default'},
+        'data': {f'FOO_{n}': BULLSHIT for n in range(50)},
+    }
+    secret['data']['topsecret.txt'] = literal('\n'.join(BULLSHIT) + '\n')
+    secret_yaml = yadu(secret)
+    for s in [values_yaml, secret_yaml]:
+        dic = yalo(s)
+        assert dic == yaml.safe_load(s)
+        # the fast dump carries the same data as the round trip dump
+        assert yalo(yadu(dic, fast=True)) == yalo(yadu(dic)) == dic
+
+    if not yaml.__with_libyaml__:
+        return
+    # LibYAML is used for both loading and dumping when it's available
+    yml = fast_yaml()
+    assert yml.Parser is yaml.CParser
+    assert yml.Emitter is yaml.CEmitter
+
+
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_profile():
+    res = run(lain, args=['--profile', 'template'])
+    report = res.output.split('\nphase ', 1)[-1]
+    summary, details = report.split('\n\n', 1)
+    phases = {line.split()[0] for line in summary.splitlines()[1:]}
+    assert {'imports', 'ensure_helm_initiated', 'subprocess'} <= phases
+    assert 'helm template' in details
+    assert PROFILE == {'enabled': False, 'records': []}
+    res = run(lain, args=['template'])
+    assert '\nphase ' not in res.output
+
+    PROFILE['enabled'] = True
+    template_env.from_string('{{ 1 + 1 }}').render()
+    (phase, detail, *_), *_ = PROFILE['records']
+    assert (phase, detail) == ('template', '<string>')
+    print_profile_report()
+
+
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_trace_file(mocker, tmp_path):
+    trace_file = str(tmp_path / 'trace.json')
+    mocker.patch('lain_cli.utils.LAIN_TRACE_FILE', trace_file)
+    for env in [ENV, os.environ]:
+        mocker.patch.dict(env, {'LAIN_TRACE_FILE': trace_file})
+        env.pop('LAIN_TRACE_PARENT', None)
+
+    run_under_click_context(lain_, args=['meta'])
+    run_under_click_context(lain_, args=['meta'], kwargs={'isolate': True})
+    with open(trace_file) as f:
+        # the closing bracket is optional in chrome trace event format
+        events = json.loads(f.read().rstrip().rstrip(',') + ']')
+
+    spans = [(e['cat'], e['name']) for e in events if e['ph'] == 'X']
+    assert spans.count(('command', 'lain wrapper-command')) == 2
+    # one in-process, one in a child process
+    assert spans.count(('command', 'lain meta')) == 2
+    assert spans.count(('lain_', 'lain meta')) == 2
+    assert ('subprocess', 'lain meta') in spans
+    pids = {e['pid'] for e in events if e['ph'] == 'M'}
+    assert len(pids) == 2
+    assert pids == {e['pid'] for e in events}
+
+
 @pytest.mark.usefixtures('dummy_helm_chart')
 def test_subprocess_run():
     cmd = ['helm', 'version', '--bad-flag']
@@ -88,12 +226,72 @@ def test_subprocess_run():
     assert wd.endswith(DUMMY_REPO)
 
 
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_lain_(mocker):
+    run = mocker.patch('lain_cli.utils.subprocess_run', wraps=subprocess_run)
+    cmd_result, completed = run_under_click_context(lain_, args=['meta'])
+    assert rc(completed) == 0
+    # lain_ should not spawn another lain process
+    assert not [c for c in run.call_args_list if c.args[0][0] == 'lain']
+    # exit code of the sub-command is propagated
+    _, completed = run_under_click_context(
+        lain_, args=['logs', 'no-such-proc'], kwargs={'check': False}
+    )
+    assert rc(completed) == 1
+    cmd_result, _ = run_under_click_context(
+        lain_, args=['logs', 'no-such-proc'], returncode=1
+    )
+    assert 'proc no-such-proc not found' in cmd_result.output
+
+
 @pytest.mark.usefixtures('dummy_helm_chart')
 def test_tell_cluster():
     _, func_result = run_under_click_context(tell_cluster)
     assert func_result == TEST_CLUSTER
 
 
+def test_version_challenge_cache(mocker, tmp_path):
+    mocker.patch('lain_cli.utils.LAIN_CACHE_DIR', str(tmp_path))
+    find = mocker.patch('lain_cli.utils.find_latest_lain_version', return_value='4.7.3')
+    spawn = mocker.patch('lain_cli.utils.spawn_version_refresh')
+    index = TEST_CLUSTER_INFO['pypi_index']
+    assert tell_latest_lain_version(index) == '4.7.3'
+    assert tell_latest_lain_version(index) == '4.7.3'
+    assert find.call_count == 1
+    assert not spawn.called
+    # stale cache is still used, while a refresh happens in the background
+    dump_cache(VERSION_CHALLENGE_CACHE, {index: {'version': '4.7.0', 'checked_at': 0}})
+    assert tell_latest_lain_version(index) == '4.7.0'
+    spawn.assert_called_once_with(index)
+    assert find.call_count == 1
+    # ttl=0 means no cache at all
+    assert tell_latest_lain_version(index, ttl=0) == '4.7.3'
+    assert find.call_count == 2
+    # failed lookups are not cached
+    dump_cache(VERSION_CHALLENGE_CACHE, {})
+    find.return_value = None
+    assert tell_latest_lain_version(index) is None
+    find.return_value = '4.7.3'
+    assert tell_latest_lain_version(index) == '4.7.3'
+    assert find.call_count == 4
+
+
+def test_tool_version_cache(mocker, tmp_path):
+    mocker.patch('lain_cli.utils.LAIN_CACHE_DIR', str(tmp_path))
+    run = mocker.patch('lain_cli.utils.subprocess_run', wraps=subprocess_run)
+    binary = tmp_path / 'fake-tool'
+    binary.write_text('#!/bin/sh\necho version: v1.0.0\n')
+    binary.chmod(0o755)
+    name = str(binary)
+    assert tell_tool_version(name) == 'v1.0.0'
+    assert tell_tool_version(name) == 'v1.0.0'
+    assert run.call_count == 1
+    # replacing the binary invalidates the cache
+    binary.write_text('#!/bin/sh\necho version: v1.10.0\n')
+    assert tell_tool_version(name) == 'v1.10.0'
+    assert run.call_count == 2
+
+
 def test_lain_meta():
     not_a_git_dir = TemporaryDirectory()
     with change_dir(not_a_git_dir.name):
@@ -127,6 +325,876 @@ def test_load_helm_values():
     assert values['jobs'] == dummy_jobs
 
 
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_kubernetes_client(mocker, kubernetes_api):
+    namespace_api = '/api/v1/namespaces/default'
+    secret_name = f'{DUMMY_APPNAME}-env'
+    kubernetes_api.routes[f'{namespace_api}/secrets/{secret_name}'] = (
+        200,
+        {
+            'kind': 'Secret',
+            'metadata': {'name': secret_name, 'resourceVersion': '1'},
+            'data': {'FOO': base64.b64encode(b'BAR').decode('utf-8')},
+        },
+    )
+    selector = f'app.kubernetes.io/name={DUMMY_APPNAME}'
+    pods = [
+        {
+            'metadata': {'name': name, 'creationTimestamp': ts},
+            'status': {'phase': phase},
+        }
+        for name, ts, phase in [
+            ('old', '2021-01-01T00:00:00Z', 'Running'),
+            ('new', '2021-01-02T00:00:00Z', 'Running'),
+            ('pending', '2021-01-03T00:00:00Z', 'Pending'),
+        ]
+    ]
+    for path, kind, items in [
+        (f'{namespace_api}/pods', 'PodList', pods),
+        ('/apis/apps/v1/namespaces/default/deployments', 'DeploymentList', []),
+        ('/apis/batch/v1/namespaces/default/jobs', 'JobList', []),
+    ]:
+        kubernetes_api.routes[f'{path}?labelSelector={selector}'] = (
+            200,
+            {'kind': kind, 'items': items},
+        )
+
+    kubectl_ = mocker.patch('lain_cli.utils.kubectl')
+    _, secret = run_under_click_context(tell_secret, args=[secret_name])
+    assert secret['data'] == {'FOO': 'BAR'}
+    assert 'resourceVersion' not in secret['metadata']
+    _, pod_name = run_under_click_context(pick_pod, kwargs={'phase': 'Running'})
+    assert pod_name == 'new'
+    res = kubectl_get('job', 'no-such-job')
+    assert rc(res) == 1
+    assert ensure_str(res.stderr) == 'Error from server (NotFound): nope'
+    assert not kubectl_.called
+    # keep-alive: all requests went through a single connection
+    assert len({client for *_, client in kubernetes_api.requests}) == 1
+    # anything the client doesn't know goes through kubectl
+    kubectl_get('ingress', selector='foo=bar')
+    kubectl_.assert_called_once_with(
+        'get', 'ingress', '-ojson', '-l', 'foo=bar', capture_output=True, check=False
+    )
+
+
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_try_to_label_nodes(mocker, kubernetes_api):
+    label_name = f'{DUMMY_APPNAME}-web'
+    nodes = [
+        {'metadata': {'name': 'node-1', 'labels': {label_name: 'true'}}},
+        {'metadata': {'name': 'node-2', 'labels': {label_name: 'true'}}},
+        {'metadata': {'name': 'node-3'}},
+    ]
+    kubernetes_api.routes['/api/v1/nodes'] = (200, {'kind': 'NodeList', 'items': nodes})
+    override_values = {'deployments': {'web': {'nodes': ['node-1', 'node-3']}}}
+    yadu(override_values, f'{CHART_DIR_NAME}/values-{TEST_CLUSTER}.yaml')
+    kubectl_ = mocker.patch('lain_cli.utils.kubectl')
+    run_under_click_context(try_to_label_nodes)
+    assert kubectl_.call_args_list == [
+        call('label', 'node', 'node-2', f'{label_name}-', '--overwrite'),
+        call('label', 'node', 'node-3', f'{label_name}=true', '--overwrite'),
+    ]
+    # nothing to do, a single read
+    nodes[1]['metadata']['labels'] = {}
+    nodes[2]['metadata']['labels'] = {label_name: 'true'}
+    kubectl_.reset_mock()
+    run_under_click_context(try_to_label_nodes)
+    assert not kubectl_.called
+
+
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_try_to_cleanup_job(mocker):
+    override_values = {
+        'jobs': {
+            'migrate': {'command': ['echo', 'migrate']},
+            'seed': {'command': ['echo', 'seed']},
+        }
+    }
+    yadu(override_values, f'{CHART_DIR_NAME}/values-{TEST_CLUSTER}.yaml')
+    load = mocker.patch('lain_cli.utils.load_helm_values', wraps=load_helm_values)
+    kubectl_ = mocker.patch('lain_cli.utils.kubectl')
+    kubectl_.return_value = subprocess.CompletedProcess([], 0)
+    run_under_click_context(try_to_cleanup_job)
+    kubectl_.assert_called_once_with(
+        'delete',
+        'job',
+        f'{DUMMY_APPNAME}-migrate',
+        f'{DUMMY_APPNAME}-seed',
+        '--ignore-not-found',
+        capture_output=True,
+        check=False,
+    )
+    assert load.call_count == 1
+
+
+def make_pod(name, ready):
+    return {
+        'metadata': {'name': name},
+        'spec': {'containers': [{'name': 'main'}]},
+        'status': {
+            'phase': 'Running',
+            'containerStatuses': [{'ready': ready, 'state': {'running': {}}}],
+        },
+    }
+
+
+def test_get_pods(mocker):
+    crashing = make_pod('crashing', False)
+    crashing['status']['containerStatuses'][0]['state'] = {
+        'waiting': {'reason': 'CrashLoopBackOff'}
+    }
+    restarting = make_pod('restarting', True)
+    restarting['status']['containerStatuses'][0]['restartCount'] = 11
+    completed = make_pod('migrate', False)
+    completed['status'] = {
+        'phase': 'Succeeded',
+        'containerStatuses': [{'state': {'terminated': {'reason': 'Completed'}}}],
+    }
+    pods = [make_pod('web', True), restarting, crashing, completed]
+    for pod in pods:
+        pod['kind'] = 'Pod'
+        pod['metadata']['creationTimestamp'] = '2021-01-01T00:00:00Z'
+
+    mocker.patch.dict(ENV, {'LAIN_KUBECTL_ONLY': 'true'})
+    kubectl_get_ = mocker.patch('lain_cli.utils.kubectl_get')
+    kubectl_get_.return_value = subprocess.CompletedProcess(
+        [], 0, stdout=json.dumps({'items': pods})
+    )
+    _, lines = get_pods(appname=DUMMY_APPNAME)
+    # only pods are listed
+    kubectl_get_.assert_called_once_with(
+        'pod', selector=f'app.kubernetes.io/name={DUMMY_APPNAME}'
+    )
+    assert [line.split()[:4] for line in lines] == [
+        ['web', '1/1', 'Running', '0'],
+        ['restarting', '1/1', 'Running', '11'],
+        ['crashing', '0/1', 'CrashLoopBackOff', '0'],
+        ['migrate', '0/1', 'Completed', '0'],
+    ]
+    _, lines = get_pods(headers=True, show_only_bad_pods=True)
+    assert lines[0].split()[:3] == ['NAME', 'READY', 'STATUS']
+    # each bad pod only once, abnormal ones first
+    assert [line.split()[0] for line in lines[1:]] == ['crashing', 'restarting']
+
+
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_resource_snapshot(mocker):
+    mocker.patch.dict(ENV, {'LAIN_KUBECTL_ONLY': 'true'})
+    web = make_pod(f'{DUMMY_APPNAME}-web-7557696ddf-52cc6', True)
+    web['metadata'].update(
+        {
+            'creationTimestamp': '2021-01-01T00:00:00Z',
+            'labels': {'app.kubernetes.io/instance': f'{DUMMY_APPNAME}-web'},
+        }
+    )
+    deploy = {'kind': 'Deployment', 'metadata': {'name': f'{DUMMY_APPNAME}-web'}}
+    items = [dict(web, kind='Pod'), deploy]
+    kubectl_get_ = mocker.patch('lain_cli.utils.kubectl_get')
+    kubectl_get_.return_value = subprocess.CompletedProcess(
+        [], 0, stdout=json.dumps({'items': items})
+    )
+
+    def look_around():
+        return (
+            pick_pod(deploy_name='web'),
+            pick_pod(deploy_name='worker'),
+            find_snapshot_item('deployment', f'{DUMMY_APPNAME}-web', DUMMY_APPNAME),
+        )
+
+    _, (web_pod, worker_pod, deploy_spec) = run_under_click_context(look_around)
+    assert web_pod == web['metadata']['name']
+    assert worker_pod is None
+    assert deploy_spec == deploy
+    # each kind is listed once, and only when asked for
+    selector = f'app.kubernetes.io/name={DUMMY_APPNAME}'
+    assert kubectl_get_.call_args_list == [
+        call('pod', selector=selector),
+        call('deployment', selector=selector),
+    ]
+    # several kinds at once, only the missing ones are listed
+    _, (_, snapshot) = run_under_click_context(resource_snapshot, args=[DUMMY_APPNAME])
+    kubectl_get_.assert_called_with('job', selector=selector)
+    assert snapshot == {
+        'pod': [dict(web, kind='Pod')],
+        'deployment': [deploy],
+        'job': [],
+    }
+    # anything that changes the cluster invalidates the snapshot
+    mocker.patch('lain_cli.utils.subprocess_run')
+    kubectl('delete', 'pod', web['metadata']['name'])
+    run_under_click_context(pick_pod)
+    assert kubectl_get_.call_count == 4
+    # long running callers can skip what's kept
+    run_under_click_context(
+        resource_snapshot, args=[DUMMY_APPNAME, ['pod']], kwargs={'fresh': True}
+    )
+    assert kubectl_get_.call_count == 5
+
+
+def test_cleanup_registry(mocker):
+    from lain_cli.registry import Registry
+
+    registry = Registry(host='registry.fake/dev')
+    mocker.patch('lain_cli.lain.tell_registry_client', return_value=registry)
+    mocker.patch.object(registry, 'list_repos', return_value=['dummy', 'centos'])
+    mocker.patch.object(
+        registry, 'list_tags', return_value=[f'tag-{i}' for i in range(1, 15)]
+    )
+    # tag-1 is running, tag-2 and tag-3 share a manifest, tag-4 shares its
+    # manifest with a recent tag
+    digests = {'tag-2': 'sha256:a', 'tag-3': 'sha256:a', 'tag-4': 'sha256:b'}
+    digests['tag-14'] = 'sha256:b'
+    mocker.patch.object(
+        registry,
+        'tell_digest',
+        side_effect=lambda repo, tag: digests.get(tag, f'sha256:{tag}'),
+    )
+    delete_digest = mocker.patch.object(registry, 'delete_digest')
+    delete_digest.return_value.status_code = 202
+    kubectl_ = mocker.patch('lain_cli.lain.kubectl')
+    kubectl_.return_value = subprocess.CompletedProcess(
+        [], 0, stdout=b'registry.fake/dev/dummy:tag-1'
+    )
+    res = run(lain, args=['admin', 'cleanup-registry', '-j', '4'])
+    registry.list_tags.assert_called_once_with('dummy')
+    delete_digest.assert_called_once_with('dummy', 'sha256:a')
+    assert 'repos: 1, old tags: 3, deleted: 1, failed: 0' in res.output
+
+
+def test_registry_rate_limited(mocker):
+    import requests
+
+    from lain_cli.registry import Registry
+
+    rate_limited = requests.Response()
+    rate_limited.status_code = 429
+    rate_limited.headers['Retry-After'] = '0'
+    ok = requests.Response()
+    ok.status_code = 200
+    ok.headers['Docker-Content-Digest'] = 'sha256:a'
+    registry = Registry(host='registry.fake/dev')
+    request = mocker.patch.object(
+        registry.session, 'request', side_effect=[rate_limited, ok]
+    )
+    assert registry.tell_digest('dummy', 'latest') == 'sha256:a'
+    assert request.call_count == 2
+
+    # has_tag falls back to listing tags if the registry keeps refusing
+    listed = requests.Response()
+    listed.status_code = 200
+    listed._content = json.dumps({'tags': ['latest']}).encode()
+    request = mocker.patch.object(
+        registry.session, 'request', side_effect=[rate_limited] * 3 + [listed]
+    )
+    assert registry.has_tag('dummy', 'latest')
+    assert request.call_count == 4
+
+
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_with_context():
+    from concurrent.futures import ThreadPoolExecutor
+
+    def look_around():
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            bare = executor.submit(context, silent=True).result()
+            wrapped = executor.submit(with_context(context)).result()
+        return context(), bare, wrapped
+
+    _, (ctx, bare, wrapped) = run_under_click_context(look_around)
+    assert bare is None
+    assert wrapped is ctx
+
+
+def test_list_waste(mocker):
+    deploys = [
+        {'metadata': {'name': name}, 'spec': {'replicas': replicas}}
+        for name, replicas in [
+            ('dummy-web', 3),
+            ('dummy-worker', 2),
+            ('dummy-cron', 1),
+            ('other-web', 4),
+        ]
+    ]
+    kubectl_get_ = mocker.patch('lain_cli.lain.kubectl_get')
+    kubectl_get_.return_value = subprocess.CompletedProcess(
+        [], 0, stdout=json.dumps({'items': deploys})
+    )
+    helm_ = mocker.patch('lain_cli.lain.helm')
+    helm_.return_value = subprocess.CompletedProcess([], 0, stdout=b'dummy\n')
+    query = mocker.patch('lain_cli.prometheus.Prometheus.query')
+    query.return_value = [{'metric': {'deploy': 'dummy-web'}, 'value': [0, '42.1']}]
+    res = run(lain, args=['admin', 'list-waste'])
+    # a single query for all deployments
+    query.assert_called_once()
+    assert 'dummy-web has 3 pods, cpu P90: 42' in res.output
+    assert 'skipping dummy because cpu data is not available' in res.output
+    assert 'other' not in res.output
+    # without cpu_by_deploy, pql_template.cpu is used for each deployment
+    pql_template = {'cpu': TEST_CLUSTER_INFO['pql_template']['cpu']}
+    cluster_info = dict(TEST_CLUSTER_INFO, pql_template=pql_template)
+    mocker.patch('lain_cli.prometheus.tell_cluster_info', return_value=cluster_info)
+    query.reset_mock()
+    cpu_p95 = mocker.patch('lain_cli.prometheus.Prometheus.cpu_p95', return_value=7)
+    res = run(lain, args=['admin', 'list-waste'])
+    assert not query.called
+    assert cpu_p95.call_args_list == [call('dummy', 'web'), call('dummy', 'worker')]
+    assert 'dummy-worker has 2 pods, cpu P90: 7' in res.output
+
+
+def test_list_unused_ingress(mocker):
+    def make_ing(name, host, svc_name, ingress_class='lain-internal'):
+        backend = {'service': {'name': svc_name}}
+        return {
+            'metadata': {
+                'name': name,
+                'annotations': {'kubernetes.io/ingress.class': ingress_class},
+            },
+            'spec': {
+                'rules': [{'host': host, 'http': {'paths': [{'backend': backend}]}}]
+            },
+        }
+
+    ings = [
+        make_ing('busy', 'busy.example.com', 'busy'),
+        make_ing('idle', 'idle.example.com', 'idle', ingress_class='lain-external'),
+        make_ing('orphan', 'orphan.example.com', 'gone'),
+        make_ing('internal', 'dummy.lain', 'dummy'),
+    ]
+    svcs = [
+        {'metadata': {'name': name}, 'spec': {'selector': {'app': name}}}
+        for name in ('busy', 'idle', 'dummy')
+    ]
+    pods = [
+        {
+            'metadata': {
+                'name': 'idle-7557696ddf-52cc6',
+                'labels': {'app': 'idle'},
+                'creationTimestamp': '2021-01-01T00:00:00Z',
+            }
+        }
+    ]
+    items = {'ingress': ings, 'svc': svcs, 'pod': pods}
+    kubectl_get_ = mocker.patch('lain_cli.lain.kubectl_get')
+    kubectl_get_.side_effect = lambda kind, check=False: subprocess.CompletedProcess(
+        [], 0, stdout=json.dumps({'items': items[kind]})
+    )
+    kubectl_ = mocker.patch('lain_cli.lain.kubectl')
+    kubectl_.return_value = subprocess.CompletedProcess([], 0, stdout=b'')
+    post = mocker.patch('lain_cli.kibana.Kibana.post')
+    buckets = [{'key': 'busy.example.com', 'doc_count': 10}]
+    post.return_value.json.return_value = {
+        'rawResponse': {'aggregations': {'vhost': {'buckets': buckets}}}
+    }
+    res = run(lain, args=['admin', 'list-unused-ingress'])
+    # one aggregation for each ingress class, no hits
+    assert post.call_count == 2
+    body = post.call_args_list[0].kwargs['json']['params']['body']
+    assert body['size'] == 0
+    assert 'k delete ing orphan' in res.output
+    report = [line.split() for line in res.output.splitlines()]
+    assert ['idle.example.com', '0', 'idle-7557696ddf-52cc6'] in report
+    assert 'busy' not in res.output
+    kubectl_.assert_called_once_with(
+        'logs', '--since=604800s', 'idle-7557696ddf-52cc6', capture_output=True
+    )
+
+    # a failed search is never taken as no traffic
+    post.return_value.json.return_value = {
+        'rawResponse': {'_shards': {'failed': 1}, 'hits': {'total': 0}}
+    }
+    res = run(lain, args=['admin', 'list-unused-ingress'])
+    assert 'cannot count requests for lain-internal ingresses' in res.output
+    assert 'k delete ing' not in res.output
+    assert 'idle.example.com' not in res.output
+
+
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_count_records_for_hosts(mocker):
+    from lain_cli.kibana import Kibana
+
+    mocker.patch.object(Kibana, 'hosts_per_query', 2)
+    hosts = [f'{i}.example.com' for i in range(5)]
+
+    def post(path, json=None):
+        body = json['params']['body']
+        query = body['query']['bool']['filter'][1]['query_string']['query']
+        buckets = [{'key': host, 'doc_count': 1} for host in hosts if host in query]
+        res = mocker.Mock()
+        res.json.return_value = {
+            'rawResponse': {'aggregations': {'vhost': {'buckets': buckets}}}
+        }
+        return res
+
+    post = mocker.patch.object(Kibana, 'post', side_effect=post)
+    _, counts = run_under_click_context(
+        lambda: Kibana().count_records_for_hosts(hosts)
+    )
+    # batched to stay below max_clause_count, and merged
+    assert post.call_count == 3
+    assert counts == dict.fromkeys(hosts, 1)
+
+
+def test_admin_get(mocker):
+    items = [
+        {
+            'metadata': {
+                'namespace': 'default',
+                'name': name,
+                'labels': labels,
+                'annotations': annotations,
+            }
+        }
+        for name, labels, annotations in [
+            ('scraped', {'app': 'dummy'}, {'prometheus.io/scrape': 'true'}),
+            ('other', {'app': 'other'}, {'prometheus.io/scrape': 'true'}),
+            ('spaces', {'app': 'dummy'}, {'note': 'has spaces = ok'}),
+            ('bare', None, None),
+        ]
+    ]
+    kubectl_ = mocker.patch('lain_cli.lain.kubectl')
+    kubectl_.return_value = subprocess.CompletedProcess(
+        [], 0, stdout=json.dumps({'items': items})
+    )
+
+    def get(*args):
+        res = run(lain, args=['admin', 'get', 'pod', *args])
+        return [line.split()[-1] for line in res.output.splitlines()[1:]]
+
+    assert get('--annotations', 'prometheus.io/scrape=true') == ['scraped', 'other']
+    assert get('--annotations', 'note=has spaces = ok') == ['spaces']
+    assert get(
+        '--annotations', 'prometheus.io/scrape=true', '--labels', 'app=dummy'
+    ) == ['scraped', 'other', 'spaces']
+    assert get(
+        '--annotations',
+        'prometheus.io/scrape=true',
+        '--labels',
+        'app=dummy',
+        '--match',
+        'all',
+    ) == ['scraped']
+    kubectl_.assert_called_with(
+        'get',
+        '--all-namespaces',
+        'pod',
+        '-ojson',
+        check=True,
+        capture_output=True,
+    )
+
+
+def test_delete_bad_pod(mocker):
+    job_pods = []
+    for name in ('migrate-abcde', 'migrate-fghij'):
+        pod = make_pod(name, False)
+        pod['metadata']['ownerReferences'] = [{'kind': 'Job', 'name': 'migrate'}]
+        job_pods.append(pod)
+
+    evicted = make_pod('dummy-web-7557696ddf-52cc6', False)
+    evicted['status'] = {'phase': 'Failed', 'reason': 'Evicted'}
+    restarting = make_pod('dummy-web-7557696ddf-x2dfr', True)
+    restarting['status']['containerStatuses'][0]['restartCount'] = 11
+    snapshot = {
+        'pod': [*job_pods, evicted, restarting, make_pod('healthy', True)],
+        'job': [{'metadata': {'name': 'migrate'}}],
+    }
+    mocker.patch('lain_cli.lain.resource_snapshot', return_value=(None, snapshot))
+    kubectl_ = mocker.patch('lain_cli.lain.kubectl')
+    res = run(lain, args=['admin', 'delete-bad-pod', '--dry-run'])
+    report = [line.split() for line in res.output.splitlines()]
+    assert report[-4:] == [
+        ['job/migrate', 'not', 'ready'],
+        ['pod/dummy-web-7557696ddf-52cc6', 'abnormal'],
+        ['pod/dummy-web-7557696ddf-x2dfr', 'restarts'],
+        ['abnormal:', '1,', 'not', 'ready:', '1,', 'restarts:', '1'],
+    ]
+    assert not kubectl_.called
+    run(lain, args=['admin', 'delete-bad-pod'])
+    assert kubectl_.call_args_list == [
+        call(
+            'delete',
+            'job',
+            'migrate',
+            '--ignore-not-found',
+            '--wait=false',
+            check=False,
+            timeout=None,
+        ),
+        call(
+            'delete',
+            'pod',
+            'dummy-web-7557696ddf-52cc6',
+            'dummy-web-7557696ddf-x2dfr',
+            '--ignore-not-found',
+            '--wait=false',
+            check=False,
+            timeout=None,
+        ),
+    ]
+
+
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_set_canary_group_final(mocker):
+    mocker.patch('lain_cli.lain.user_challenge')
+    mocker.patch('lain_cli.lain.tell_release_image', return_value='abc')
+    mocker.patch('lain_cli.lain.tell_helm_options', return_value=[])
+    mocker.patch('lain_cli.lain.tell_webhook_client', return_value=None)
+    mocker.patch('lain_cli.lain.wait_for_pod_up', return_value=['web-1'])
+    steps = mocker.Mock()
+    mocker.patch('lain_cli.lain.helm', steps.helm)
+    steps.follow_rollouts.return_value = {f'{DUMMY_APPNAME}-web': (1, None)}
+    mocker.patch('lain_cli.lain.follow_rollouts', steps.follow_rollouts)
+    run(lain, args=['set-canary-group', '--final'])
+    # the canary is only deleted after the new pods are serving
+    assert [c[0] for c in steps.mock_calls] == ['helm', 'follow_rollouts', 'helm']
+    steps.follow_rollouts.assert_called_once_with([f'{DUMMY_APPNAME}-web'])
+    steps.helm.assert_called_with('delete', f'{DUMMY_APPNAME}-canary')
+
+    steps.reset_mock()
+    steps.follow_rollouts.return_value = {
+        f'{DUMMY_APPNAME}-web': (1, 'timed out waiting')
+    }
+    res = run(lain, args=['set-canary-group', '--final'], returncode=1)
+    assert 'timed out waiting' in res.output
+    assert steps.helm.call_count == 1
+
+
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_rolling_restart(mocker):
+    contexts = []
+
+    def kubectl_(*args, **kwargs):
+        contexts.append(context(silent=True))
+        if args[:2] == ('rollout', 'status') and 'worker' in args[2]:
+            return subprocess.CompletedProcess(args, 1, stderr=b'timed out waiting')
+        return subprocess.CompletedProcess(args, 0, stdout=b'', stderr=b'')
+
+    kubectl_ = mocker.patch('lain_cli.utils.kubectl', side_effect=kubectl_)
+    challenge = mocker.patch('lain_cli.utils.kubectl_version_challenge')
+    res = run(lain, args=['restart', '--rolling', 'web', 'worker'], returncode=1)
+    challenge.assert_called_once_with()
+    # workers see the same click context
+    assert None not in contexts
+    assert f'{DUMMY_APPNAME}-web ready after' in res.output
+    assert f'{DUMMY_APPNAME}-worker failed after' in res.output
+    assert 'timed out waiting' in res.output
+    patches = [c for c in kubectl_.call_args_list if c.args[0] == 'patch']
+    # patched concurrently, in no particular order
+    assert sorted(c.args[2] for c in patches) == [
+        f'{DUMMY_APPNAME}-web',
+        f'{DUMMY_APPNAME}-worker',
+    ]
+    assert 'kubectl.kubernetes.io/restartedAt' in patches[0].args[4]
+    kubectl_.assert_any_call(
+        'rollout',
+        'status',
+        f'deployment/{DUMMY_APPNAME}-web',
+        '--timeout=600s',
+        capture_output=True,
+        check=False,
+        timeout=None,
+    )
+
+
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_update_image(mocker):
+    registry = mocker.patch('lain_cli.lain.tell_registry_client').return_value
+    registry.make_image.return_value = 'registry.example.com/dummy:abc'
+    mocker.patch('lain_cli.lain.tell_image_tag', return_value='abc')
+
+    def kubectl_(*args, **kwargs):
+        return subprocess.CompletedProcess(
+            args, 0, stdout=f'{args[2]} image updated'.encode(), stderr=b''
+        )
+
+    mocker.patch('lain_cli.lain.kubectl', side_effect=kubectl_)
+    challenge = mocker.patch('lain_cli.lain.kubectl_version_challenge')
+    mocker.patch('lain_cli.utils.kubectl_version_challenge')
+    follow_kubectl = mocker.patch(
+        'lain_cli.utils.kubectl',
+        return_value=subprocess.CompletedProcess([], 0, stdout=b'', stderr=b''),
+    )
+    res = run(lain, args=['update-image', '--wait', 'web'])
+    assert f'deployment/{DUMMY_APPNAME}-web image updated' in res.output
+    assert f'{DUMMY_APPNAME}-web ready after' in res.output
+    challenge.assert_called_once_with()
+    follow_kubectl.assert_any_call(
+        'rollout',
+        'status',
+        f'deployment/{DUMMY_APPNAME}-web',
+        '--timeout=600s',
+        capture_output=True,
+        check=False,
+        timeout=None,
+    )
+
+    def kubectl_(*args, **kwargs):
+        return subprocess.CompletedProcess(args, 1, stdout=b'', stderr=b'not found')
+
+    mocker.patch('lain_cli.lain.kubectl', side_effect=kubectl_)
+    res = run(lain, args=['update-image', 'web'], returncode=1)
+    assert f'deployment/{DUMMY_APPNAME}-web: not found' in res.output
+    assert 'abort due to kubectl failure' in res.output
+
+
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_refresh_app_status(mocker):
+    from lain_cli.prompt import CONTENT_VENDERER, refresh_pod_text
+
+    record = PodRecord(
+        'crashing', (0, 1), 'Running', 3, 'CrashLoopBackOff', '', '', None
+    )
+    mocker.patch(
+        'lain_cli.prompt.get_pod_records',
+        return_value=(subprocess.CompletedProcess([], 0), [record]),
+    )
+    mocker.patch('lain_cli.prompt.format_pod_records', return_value=['crashing'])
+    mocker.patch.dict(CONTENT_VENDERER, {'bad_pods': [], 'event_text': ''})
+    kubectl_threads = []
+
+    def kubectl_(*args, **kwargs):
+        # blocking calls must stay out of the event loop thread
+        kubectl_threads.append(threading.current_thread())
+        return subprocess.CompletedProcess(args, 0, stdout=b'oops', stderr=b'')
+
+    kubectl_ = mocker.patch('lain_cli.prompt.kubectl', side_effect=kubectl_)
+
+    async def refresh():
+        await refresh_pod_text()
+        # events are refreshed in the background, because bad pods changed
+        while not CONTENT_VENDERER['event_text']:
+            await asyncio.sleep(0.01)
+
+    def refresh_app_status():
+        ctx = context()
+        ctx.obj['too_many_pods'] = False
+        asyncio.run(refresh())
+
+    run_under_click_context(refresh_app_status)
+    assert CONTENT_VENDERER['pod_text'] == 'crashing'
+    assert CONTENT_VENDERER['event_text'] == 'oops'
+    kubectl_.assert_called_once_with(
+        'logs', '--tail=50', 'crashing', capture_output=True, check=False
+    )
+    assert threading.main_thread() not in kubectl_threads
+
+
+
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_build_app_status_command():
+    from lain_cli.prompt import build_app_status_command
+
+    def titles():
+        build_app_status_command()
+        obj = context().obj
+        return obj['watch_pod_title'], obj['watch_top_title']
+
+    _, (pod_title, top_title) = run_under_click_context(titles)
+    # pods are not listed by kubectl get pod anymore
+    assert pod_title == f'pods of {DUMMY_APPNAME}, refreshed every 2s'
+    assert top_title.startswith('k top po')
+
+
+def test_refresh_periodically(mocker):
+    from lain_cli.prompt import CONTENT_VENDERER, refresh_periodically
+
+    mocker.patch.dict(CONTENT_VENDERER, {'top_text': ''})
+    seen = []
+
+    async def refresh():
+        seen.append(CONTENT_VENDERER['top_text'])
+        if len(seen) == 1:
+            raise ValueError('truncated output')
+
+    async def drive():
+        task = asyncio.ensure_future(refresh_periodically(refresh, 'top_text', 0))
+        while len(seen) < 2:
+            await asyncio.sleep(0)
+        task.cancel()
+
+    asyncio.run(drive())
+    # the panel shows the error, and keeps refreshing
+    assert 'truncated output' in seen[1]
+
+
+def test_admin_x(mocker):
+    podnames = ['web-7557696ddf-2', 'web-7557696ddf-1', 'worker-5f8f9d7b6c-1', 'db-0']
+    snapshot = {'pod': [{'metadata': {'name': name}} for name in podnames]}
+    mocker.patch('lain_cli.lain.resource_snapshot', return_value=(None, snapshot))
+
+    def exec_(*args, **kwargs):
+        podname = args[1]
+        # the first container finishes last
+        sleep(0.1 if podname == 'db-0' else 0)
+        return subprocess.CompletedProcess(args, 0, stdout=f'hello from {podname}')
+
+    kubectl_ = mocker.patch('lain_cli.lain.kubectl', side_effect=exec_)
+    challenge = mocker.patch('lain_cli.lain.kubectl_version_challenge')
+    res = run(lain, args=['admin', 'x', '-j', '3', '--timeout', '5s', '--', 'hostname'])
+    assert res.output.splitlines()[-6:] == [
+        'command succeeds for db-0',
+        'hello from db-0',
+        'command succeeds for web-7557696ddf-1',
+        'hello from web-7557696ddf-1',
+        'command succeeds for worker-5f8f9d7b6c-1',
+        'hello from worker-5f8f9d7b6c-1',
+    ]
+    # checked once before the threads start, rather than inside each of them
+    challenge.assert_called_once_with()
+    kubectl_.assert_any_call(
+        'exec',
+        'db-0',
+        '--',
+        'hostname',
+        check=False,
+        timeout=5,
+        capture_output=True,
+        silent=True,
+    )
+    # network errors abort the whole thing
+    kubectl_.side_effect = None
+    kubectl_.return_value = subprocess.CompletedProcess(
+        [], 1, stderr=b'Unable to connect to the server'
+    )
+    run(lain, args=['admin', 'x', '-j', '3', '--', 'hostname'], returncode=1)
+
+
+def test_wait_for_pod_up(mocker, kubernetes_api):
+    sleep = mocker.patch('lain_cli.utils.sleep')
+    pods_path = '/api/v1/namespaces/default/pods'
+    podlist = {
+        'kind': 'PodList',
+        'metadata': {'resourceVersion': '1'},
+        'items': [make_pod('web', True), make_pod('worker', False)],
+    }
+    kubernetes_api.routes[f'{pods_path}?labelSelector=foo=bar'] = (200, podlist)
+    events = [
+        {'type': 'BOOKMARK', 'object': {'metadata': {'resourceVersion': '2'}}},
+        {'type': 'MODIFIED', 'object': make_pod('worker', True)},
+    ]
+    kubernetes_api.routes[pods_path] = (
+        200,
+        ''.join(f'{json.dumps(e)}\n' for e in events),
+    )
+    assert wait_for_pod_up('foo=bar') == ['web', 'worker']
+    watch = kubernetes_api.requests[-1][1]
+    assert 'watch=1' in watch
+    assert 'resourceVersion=1' in watch
+    assert not sleep.called
+
+
+def test_wait_for_pod_up_polling(mocker):
+    mocker.patch.dict(ENV, {'LAIN_KUBECTL_ONLY': 'true'})
+    sleep = mocker.patch('lain_cli.utils.sleep')
+    podlists = [
+        {'items': [make_pod('worker', False)]},
+        {'items': [make_pod('worker', True)]},
+    ]
+    kubectl_get_ = mocker.patch('lain_cli.utils.kubectl_get')
+    kubectl_get_.side_effect = [
+        subprocess.CompletedProcess([], 0, stdout=json.dumps(podlist))
+        for podlist in podlists
+    ]
+    assert wait_for_pod_up('foo=bar') == ['worker']
+    kubectl_get_.assert_called_with('pod', selector='foo=bar')
+    sleep.assert_called_once_with(3)
+
+
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_wait_for_svc_up(mocker):
+    from requests.exceptions import ConnectionError
+
+    clock = [0]
+    mocker.patch('lain_cli.utils.time', side_effect=lambda: clock[0])
+    sleep = mocker.patch('lain_cli.utils.sleep')
+    sleep.side_effect = lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+    svclist = {
+        'items': [
+            {'metadata': {'name': name}, 'spec': {'ports': [{'port': 80}]}}
+            for name in ('web', 'worker', 'slow')
+        ]
+    }
+    kubectl_get_ = mocker.patch('lain_cli.utils.kubectl_get')
+    kubectl_get_.return_value = subprocess.CompletedProcess(
+        [], 0, stdout=json.dumps(svclist)
+    )
+    probes = []
+
+    def get(url, timeout=None):
+        probes.append(url)
+        if url == 'http://worker:80' and probes.count(url) < 3:
+            raise ConnectionError('connection refused')
+        if url == 'http://slow:80':
+            raise ConnectionError('connection refused')
+
+    mocker.patch('requests.Session.get', side_effect=get)
+    _, res = run_under_click_context(wait_for_svc_up, kwargs={'tries': 1})
+    kubectl_get_.assert_called_once_with(
+        'svc', selector=f'helm.sh/chart={DUMMY_APPNAME}'
+    )
+    assert not res['up']
+    assert set(res['durations']) == {'http://web:80', 'http://worker:80'}
+    assert list(res['late']) == ['http://slow:80']
+    # urls that are up are not probed again
+    assert probes.count('http://web:80') == 1
+    assert probes.count('http://worker:80') == 3
+    # backoff instead of a fixed 3s sleep
+    assert [c.args[0] for c in sleep.call_args_list] == [0.5, 1, 1.5]
+    assert res['durations']['http://worker:80'] == 1.5
+
+
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_lazy_obj(mocker):
+    load = mocker.patch('lain_cli.utils.load_helm_values', wraps=load_helm_values)
+    run_under_click_context(lain_meta)
+    assert not load.called
+
+    def read_obj():
+        obj = context().obj
+        secret_name = obj['secret_name']
+        assert obj['values']['appname'] == obj['appname'] == DUMMY_APPNAME
+        return secret_name, template_env.from_string('{{ urls }}').render(**obj)
+
+    _, (secret_name, urls) = run_under_click_context(read_obj)
+    assert secret_name == f'{DUMMY_APPNAME}-secret'
+    assert DUMMY_URL in urls
+    assert load.call_count == 1
+
+    # several threads reading the same lazy key at once
+    def slow_meta():
+        sleep(0.05)
+        return {'lain_meta': 'abc'}
+
+    def read_concurrently():
+        from concurrent.futures import ThreadPoolExecutor
+
+        obj = context().obj
+        obj.lazy(['lain_meta'], slow_meta)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            return list(executor.map(lambda _: obj['lain_meta'], range(4)))
+
+    _, metas = run_under_click_context(read_concurrently)
+    assert metas == ['abc'] * 4
+
+
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_helm_values_cache(mocker, tmp_path):
+    mocker.patch('lain_cli.utils.LAIN_CACHE_DIR', str(tmp_path))
+    schema_load = mocker.spy(HelmValuesSchema, 'load')
+    _, values = run_under_click_context(load_helm_values)
+    _, cached_values = run_under_click_context(load_helm_values)
+    assert schema_load.call_count == 1
+    assert cached_values == values
+    assert isinstance(cached_values['publish_to'], set)
+    assert cached_values['procs']['web'] is cached_values['deployments']['web']
+    # any change in values files invalidates the cache
+    yadu({'labels': {'foo': 'bar'}}, f'{CHART_DIR_NAME}/values-{TEST_CLUSTER}.yaml')
+    _, values = run_under_click_context(load_helm_values)
+    assert schema_load.call_count == 2
+    assert values['labels'] == {'foo': 'bar'}
+
+
 @pytest.mark.usefixtures('dummy_helm_chart')
 def test_tell_helm_options():
     _, options = run_under_click_context(